@@ -0,0 +1,516 @@
+"""
+Офлайн-бенчмарк пайплайна: поднимает локальные заглушки OpenAI (chat + images),
+Telegram Bot API, RSS-лент и Wikipedia «В этот день», прогоняет
+scheduled_news_post / scheduled_rubric_post / scheduled_history_post целиком
+и печатает p50/p95, число вызовов LLM и объём трафика на прогон.
+Плюс микробенчмарки _polish_and_to_html, _story_id и _score_fin_event и проверка
+кластеризации на настоящих дублях заголовков (DUP_HEADLINES) и ужатия постов
+с инициалами и сокращениями (COMPACT_CASES); провал — код выхода 1.
+
+    python bench.py                         # всё, по 10 прогонов каждого вида
+    python bench.py --runs 30 --kinds news --llm-latency 0.5 --url-fail-rate 0.5
+    python bench.py --micro-only --out bench_output.txt
+    python bench.py --kinds rubric_long      # посты чуть длиннее лимита: ужатие без лишних вызовов LLM
+
+Сеть наружу не нужна: main.py импортируется с ENV, указывающими на заглушки.
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+import timeit
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# ─── Заглушки сервисов ────────────────────────────────────────────────────────
+STATS_LOCK = threading.Lock()
+STATS = {}  # (сервис, поле) -> число
+
+
+def _count(service: str, field: str, n: int = 1):
+    with STATS_LOCK:
+        STATS[(service, field)] = STATS.get((service, field), 0) + n
+
+
+def _stats_snapshot() -> dict:
+    with STATS_LOCK:
+        return dict(STATS)
+
+
+_WORDS = ("рынок ставка рубль нефть биржа облигации дивиденды инфляция банк инвесторы "
+          "доходность портфель акции индекс валюта бюджет спрос экспорт прибыль риск").split()
+_FIN_EVENTS = ["основан Нью-Йоркская фондовая биржа", "крах биржи и банковский кризис",
+               "деноминация рубля", "введён золотой стандарт", "дефолт по государственному долгу",
+               "Bretton Woods conference opens", "stock market crash", "central bank founded"]
+_PLAIN_EVENTS = ["открыт новый мост", "родился поэт", "подписан мирный договор",
+                 "first flight of the airship", "a comet was observed"]
+
+
+def _sentence(rnd: random.Random) -> str:
+    words = rnd.sample(_WORDS, rnd.randint(5, 9))
+    return words[0].capitalize() + " " + " ".join(words[1:]) + "."
+
+
+def fake_post(rnd: random.Random, target: int) -> str:
+    """Пост в раскладке SYSTEM_PROMPT длиной около target символов."""
+    head = ["📈 " + _sentence(rnd)[:-1], "🔍 Что это значит для инвестора?", "",
+            " ".join(_sentence(rnd) for _ in range(2)), "", "Аналитика:"]
+    analysis = [_sentence(rnd)]
+    tail = ["Прогноз:", _sentence(rnd), "Шаги:"] + \
+           [f"{i}. {_sentence(rnd)}" for i in range(1, rnd.randint(3, 5) + 1)] + \
+           ["Вывод:", _sentence(rnd), "", "А вы что думаете об этом?"]
+    while len("\n".join(head + [" ".join(analysis)] + tail)) < target:
+        analysis.append(_sentence(rnd))
+    return "\n".join(head + [" ".join(analysis)] + tail)
+
+
+def fake_rss(feed: str, now: datetime, items: int) -> bytes:
+    rnd = random.Random(feed)
+    entries = []
+    for i in range(items):
+        # общие слова у соседних лент → сюжеты кластеризуются
+        topic = random.Random(i).sample(_WORDS, 4)
+        title = " ".join(topic + rnd.sample(_WORDS, 2)).capitalize()
+        published = format_datetime(now - timedelta(hours=i, minutes=rnd.randint(0, 59)))
+        entries.append(f"<item><title>{title}</title><link>https://example.com/{feed}/{i}?utm_source=rss</link>"
+                       f"<description>{' '.join(_sentence(rnd) for _ in range(3))}</description>"
+                       f"<pubDate>{published}</pubDate></item>")
+    return (f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>{feed}</title>'
+            + "".join(entries) + "</channel></rss>").encode("utf-8")
+
+
+def fake_onthisday(lang: str, m: int, d: int) -> bytes:
+    rnd = random.Random(f"{lang}-{m}-{d}")
+    events = []
+    for i in range(40):
+        text = rnd.choice(_FIN_EVENTS if i % 5 == 0 else _PLAIN_EVENTS)
+        year = 1700 + rnd.randint(0, 320)
+        events.append({"year": year, "text": f"{text} ({year})",
+                       "pages": [{"normalizedtitle": text.title(), "extract": text + ". " + _sentence(rnd),
+                                  "content_urls": {"desktop": {"page": f"https://{lang}.wikipedia.org/wiki/{year}"}}}]})
+    return json.dumps({"events": events}, ensure_ascii=False).encode("utf-8")
+
+
+# настоящие дубли из разных изданий: (сюжет, источник, заголовок, начало summary);
+# сюжет None — отдельная новость с тем же словарём, ни к кому не клеится
+DUP_HEADLINES = [
+    ("cbr", "rbc.ru", "ЦБ сохранил ключевую ставку на уровне 21%",
+     "Совет директоров Банка России принял решение сохранить ключевую ставку. Регулятор указал, что инфляционное давление остаётся высоким."),
+    ("cbr", "interfax.ru", "Банк России сохранил ключевую ставку 21% годовых",
+     "Банк России по итогам заседания совета директоров в пятницу оставил ставку без изменений, сообщается в пресс-релизе регулятора."),
+    ("cbr", "kommersant.ru", "Центробанк оставил ключевую ставку без изменений — 21%",
+     "Аналитики, опрошенные «Коммерсантом», в большинстве ожидали такого решения. Следующее заседание запланировано на июль."),
+    ("btc", "rbc.ru", "Биткоин обновил исторический максимум и превысил $110 тыс.",
+     "Стоимость первой криптовалюты впервые в истории поднялась выше отметки, следует из данных CoinMarketCap."),
+    ("btc", "forklog.com", "Курс биткоина впервые превысил $110 000",
+     "Цена первой криптовалюты достигла нового рекорда на фоне притока средств в спотовые ETF."),
+    ("btc", "bits.media", "Биткоин установил новый рекорд, поднявшись выше $110 000",
+     "По данным TradingView, котировки BTC на Binance достигали отметки в ходе азиатской сессии."),
+    ("btc_en", "coindesk.com", "Bitcoin hits record high above $110,000",
+     "The largest cryptocurrency extended its rally as inflows into U.S. spot ETFs continued for a seventh straight day."),
+    ("btc_en", "theblock.co", "Bitcoin surges past $110,000 to new all-time high",
+     "BTC climbed to a fresh peak on Thursday, according to The Block's price page, as traders piled into call options."),
+    ("fed", "reuters.com", "Fed holds rates steady, still sees two cuts this year",
+     "The Federal Reserve left its benchmark overnight interest rate unchanged in the 4.25%-4.50% range on Wednesday."),
+    ("fed", "apnews.com", "Federal Reserve keeps interest rates unchanged, still expects two cuts in 2025",
+     "Policymakers are waiting to see how tariffs affect inflation before resuming cuts, Chair Jerome Powell said."),
+    ("fed", "marketwatch.com", "Fed leaves rates unchanged, projects two rate cuts this year",
+     "Stocks were little changed after the decision as investors parsed the central bank's new economic projections."),
+    ("opec", "tass.ru", "ОПЕК+ договорилась увеличить добычу нефти в августе",
+     "Восемь стран альянса на онлайн-встрече согласовали повышение квот на 548 тыс. баррелей в сутки."),
+    ("opec", "interfax.ru", "Страны ОПЕК+ согласовали увеличение добычи нефти с августа",
+     "Решение принято на видеоконференции в субботу, говорится в сообщении секретариата картеля."),
+    ("sber", "rbc.ru", "Сбербанк выплатит рекордные дивиденды за 2024 год",
+     "Наблюдательный совет банка рекомендовал направить на выплаты половину чистой прибыли по МСФО."),
+    ("sber", "vedomosti.ru", "Набсовет Сбербанка рекомендовал рекордные дивиденды за 2024 год",
+     "Акционеры получат 34,84 руб. на акцию, дата закрытия реестра — 18 июля."),
+    # перепечатка: заголовки разные, лид слово в слово
+    ("yndx", "rbc.ru", "Акции «Яндекса» подскочили на 7% на Мосбирже",
+     "Компания отчиталась о росте выручки на 34% во втором квартале и повысила прогноз по скорректированной EBITDA на год."),
+    ("yndx", "finam.ru", "Бумаги МКПАО «Яндекс» выросли после отчёта",
+     "Компания отчиталась о росте выручки на 34% во втором квартале и повысила прогноз по скорректированной EBITDA на год."),
+    (None, "rbc.ru", "ЦБ допустил снижение ключевой ставки в сентябре",
+     "Зампред Банка России заявил, что регулятор может вернуться к снижению ставки, если инфляция продолжит замедляться."),
+    (None, "interfax.ru", "Инфляция в России замедлилась до 9,4% годовых",
+     "Годовая инфляция по итогам мая снизилась, следует из данных Росстата."),
+    (None, "coindesk.com", "Bitcoin falls below $100,000 as ETF outflows mount",
+     "Spot bitcoin ETFs recorded their largest weekly outflows since February."),
+    (None, "forklog.com", "Эфир подорожал на 8% после одобрения ETF",
+     "Стоимость второй по капитализации криптовалюты выросла на фоне решения SEC."),
+    (None, "reuters.com", "Powell says Fed could cut rates as soon as September",
+     "Fed Chair Jerome Powell told lawmakers the central bank is in no hurry but the door is open."),
+    (None, "tass.ru", "Цены на нефть Brent упали ниже $65 за баррель",
+     "Котировки опустились впервые с апреля на фоне данных о росте запасов в США."),
+    (None, "vedomosti.ru", "ВТБ перенёс решение о дивидендах за 2024 год",
+     "Набсовет банка рассмотрит вопрос о выплатах на следующем заседании."),
+]
+
+
+
+class FakeServices(BaseHTTPRequestHandler):
+    """Один сервер на всё: /v1/* — OpenAI, /bot<token>/* — Telegram,
+    /rss/*.xml, /wiki/* и /img/cover.png — фикстуры."""
+    protocol_version = "HTTP/1.1"
+    cfg = None  # argparse.Namespace
+    rnd = random.Random(0)
+    feeds = {}  # путь -> (тело, etag)
+    llm_len = None  # (средняя, sd) вместо --llm-len/--llm-len-sd — для сценария rubric_long
+    image = b""
+
+    def log_message(self, *args):
+        pass
+
+    def _latency(self, mean: float) -> float:
+        # логнормальный хвост: медиана около mean, редкие медленные ответы
+        return mean * self.rnd.lognormvariate(0, 0.5) if mean > 0 else 0.0
+
+    def _body(self, service: str) -> bytes:
+        size = int(self.headers.get("Content-Length") or 0)
+        _count(service, "bytes_in", size)
+        return self.rfile.read(size) if size else b""
+
+    def _send(self, service: str, status: int, body: bytes, ctype="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        _count(service, "bytes_out", len(body))
+
+    def do_GET(self):
+        if self.path in self.feeds:
+            body, etag = self.feeds[self.path]
+            _count("rss", "requests")
+            if self.headers.get("If-None-Match") == etag:
+                return self._send("rss", 304, b"", headers={"ETag": etag})
+            return self._send("rss", 200, body, "application/rss+xml", {"ETag": etag})
+        if self.path.startswith("/wiki/"):
+            _, _, lang, _, _, m, d = self.path.split("/")
+            _count("wiki", "requests")
+            time.sleep(self._latency(self.cfg.wiki_latency))
+            return self._send("wiki", 200, fake_onthisday(lang, int(m), int(d)))
+        if self.path == "/img/cover.png":
+            _count("img", "requests")
+            return self._send("img", 200, self.image, "image/png")
+        self._send("other", 404, b"{}")
+
+    def do_POST(self):
+        if self.path == "/v1/chat/completions":
+            return self._chat(json.loads(self._body("openai") or b"{}"))
+        if self.path == "/v1/images/generations":
+            self._body("openai")
+            _count("openai", "image_calls")
+            time.sleep(self._latency(self.cfg.image_latency))
+            host = self.headers.get("Host")
+            return self._send("openai", 200, json.dumps(
+                {"created": int(time.time()), "data": [{"url": f"http://{host}/img/cover.png"}]}).encode())
+        if self.path.startswith("/bot") and self.path.endswith("/sendPhoto"):
+            return self._send_photo()
+        self._body("other")
+        self._send("other", 404, b"{}")
+
+    def _chat(self, req: dict):
+        _count("openai", "chat_calls")
+        max_tokens = req.get("max_tokens") or 4096
+        mean, sd = self.llm_len or (self.cfg.llm_len, self.cfg.llm_len_sd)
+        target = max(200, int(self.rnd.gauss(mean, sd)))
+        text, finish = fake_post(self.rnd, target), "stop"
+        if len(text) / 2.5 > max_tokens:  # ~2.5 символа кириллицы на токен
+            text, finish = text[:int(max_tokens * 2.5)], "length"
+        prompt_tokens = sum(len(m.get("content") or "") for m in req.get("messages", [])) // 3
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": int(len(text) / 2.5),
+                 "total_tokens": prompt_tokens + int(len(text) / 2.5)}
+        latency = self._latency(self.cfg.llm_latency)
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": req.get("model", "gpt-4o")}
+        if not req.get("stream"):
+            time.sleep(latency)
+            return self._send("openai", 200, json.dumps(dict(base, object="chat.completion", usage=usage, choices=[
+                {"index": 0, "finish_reason": finish,
+                 "message": {"role": "assistant", "content": text}}]), ensure_ascii=False).encode())
+        # стрим: SSE кусками, задержка размазана по чанкам
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = [text[i:i + 12] for i in range(0, len(text), 12)]
+        events = [dict(base, object="chat.completion.chunk", choices=[
+            {"index": 0, "delta": {"content": p}, "finish_reason": None}]) for p in pieces]
+        events.append(dict(base, object="chat.completion.chunk", choices=[
+            {"index": 0, "delta": {}, "finish_reason": finish}]))
+        events.append(dict(base, object="chat.completion.chunk", choices=[], usage=usage))
+        try:
+            for ev in events:
+                data = f"data: {json.dumps(ev, ensure_ascii=False)}\n\n".encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                _count("openai", "bytes_out", len(data))
+                time.sleep(latency / len(events))
+            done = b"data: [DONE]\n\n"
+            self.wfile.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(done), done))
+        except (BrokenPipeError, ConnectionResetError):
+            _count("openai", "streams_aborted")  # main оборвал стрим: подпись не влезет
+            self.close_connection = True
+
+    def _send_photo(self):
+        body = self._body("telegram")
+        # JSON — фото строкой (URL или file_id), multipart — загрузка файла
+        photo = json.loads(body).get("photo", "") if self.headers.get(
+            "Content-Type", "").startswith("application/json") else None
+        via = "file" if photo is None else ("url" if photo.startswith("http") else "file_id")
+        _count("telegram", "sends_" + via)
+        time.sleep(self._latency(self.cfg.tg_latency))
+        if self.rnd.random() < self.cfg.flood_rate:
+            _count("telegram", "retry_after")
+            return self._send("telegram", 429, json.dumps(
+                {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                 "parameters": {"retry_after": 1}}).encode())
+        if via == "url" and self.rnd.random() < self.cfg.url_fail_rate:
+            return self._send("telegram", 400, json.dumps(
+                {"ok": False, "error_code": 400,
+                 "description": "Bad Request: failed to get HTTP URL content"}).encode())
+        file_id = photo if via == "file_id" else "AgAC" + hashlib.sha1(body).hexdigest()
+        sizes = [{"file_id": file_id + suffix, "file_unique_id": suffix or "x", "width": w, "height": w}
+                 for suffix, w in (("-s", 90), ("-m", 320), ("", 1024))]
+        return self._send("telegram", 200, json.dumps({"ok": True, "result": {
+            "message_id": self.rnd.randint(1, 10 ** 6), "date": int(time.time()),
+            "chat": {"id": -100, "type": "channel"}, "photo": sizes}}).encode())
+
+
+def start_services(cfg) -> str:
+    FakeServices.cfg = cfg
+    FakeServices.rnd = random.Random(cfg.seed)
+    FakeServices.image = random.Random(cfg.seed).randbytes(cfg.image_kb * 1024)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeServices)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# ─── Прогон ───────────────────────────────────────────────────────────────────
+def _pct(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] if ordered else 0.0
+
+
+def import_main(cfg, base: str):
+    """main.py читает ENV при импорте — выставляем их на заглушки до import."""
+    os.environ.update({
+        "TELEGRAM_TOKEN": "123:bench", "CHANNEL_ID": "@bench", "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": f"{base}/v1", "TELEGRAM_API_URL": f"{base}/bot",
+        "ONTHISDAY_URL": base + "/wiki/{lang}/onthisday/events/{m}/{d}",
+        "DATA_DIR": tempfile.mkdtemp(prefix="bench-"),
+        "PRERENDER_ENABLED": "0", "LLM_CACHE_ENABLED": "0", "TRACE_ENABLED": "0",
+        "GEN_STREAM": "1" if cfg.stream else "0",
+        "MIRROR_CHANNELS": ",".join(f"@mirror{i}" for i in range(cfg.mirrors)),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    logging.basicConfig(level=logging.WARNING)  # раньше basicConfig в main — без INFO-шума
+    import main
+    now = datetime.now(timezone.utc)
+    FakeServices.feeds = {}
+    sources = {}
+    for t, theme in enumerate(main.news_themes):
+        sources[theme] = []
+        for i in range(cfg.feeds):
+            path = f"/rss/{t}-{i}.xml"
+            body = fake_rss(f"{t}-{i}", now, cfg.feed_items)
+            FakeServices.feeds[path] = (body, '"%s"' % hashlib.sha1(body).hexdigest()[:16])
+            sources[theme].append(base + path)
+    main.rss_sources = sources
+    return main
+
+
+def _reset_caches(main):
+    with main.NEWS_STORE_LOCK:
+        main._NEWS_STORE.clear()
+    with main.FEED_CACHE_LOCK:
+        main._FEED_CACHE.clear()
+    with main.ONTHISDAY_LOCK:
+        main._ONTHISDAY.clear()
+
+
+def run_pipeline(main, cfg) -> list:
+    jobs = {"news": main.scheduled_news_post, "rubric": main.scheduled_rubric_post,
+            "history": main.scheduled_history_post,
+            # рубрика с перелётом лимита на десятки символов: должна ужиматься локально,
+            # т.е. ~1 вызов LLM на пост и без оборванных стримов
+            "rubric_long": main.scheduled_rubric_post}
+    if not cfg.cold:
+        # как при старте приложения: прогрев хранилища новостей и индекса «В этот день»
+        main.ingest_feeds()
+        main.prefetch_onthisday()
+    rows = []
+    for kind in cfg.kinds:
+        lat, ok, per_run = [], 0, []
+        FakeServices.llm_len = (cfg.long_len, 20) if kind == "rubric_long" else None
+        for _ in range(cfg.runs):
+            if cfg.cold:
+                _reset_caches(main)
+            before = _stats_snapshot()
+            started = time.perf_counter()
+            ok += bool(jobs[kind]())
+            lat.append(time.perf_counter() - started)
+            after = _stats_snapshot()
+            per_run.append({k: after.get(k, 0) - before.get(k, 0) for k in after})
+        total = lambda field, services=None: sum(
+            v for r in per_run for (s, f), v in r.items()
+            if f == field and (services is None or s in services)) / len(per_run)
+        rows.append({
+            "kind": kind, "runs": cfg.runs, "ok": ok,
+            "p50_s": _pct(lat, 0.50), "p95_s": _pct(lat, 0.95),
+            "llm_calls": total("chat_calls"), "image_calls": total("image_calls"),
+            "streams_aborted": total("streams_aborted"),
+            "tg_url": total("sends_url"), "tg_file": total("sends_file"),
+            "tg_file_id": total("sends_file_id"), "tg_retry_after": total("retry_after"),
+            "kb_openai": (total("bytes_in", {"openai"}) + total("bytes_out", {"openai"})) / 1024,
+            "kb_telegram": (total("bytes_in", {"telegram"}) + total("bytes_out", {"telegram"})) / 1024,
+            "kb_feeds": (total("bytes_out", {"rss", "wiki", "img"})) / 1024,
+        })
+    return rows
+
+
+# ─── Проверка ужатия ──────────────────────────────────────────────────────────
+# посты, где точка стоит внутри предложения: инициалы, «г.», «руб.», «т.е.»
+COMPACT_CASES = {
+    "initials": """📈 ЦБ сохранил ставку 21%
+
+Регулятор оставил ставку без изменений.
+
+**Аналитика:**
+Рынок ждал этого решения заранее.
+Ключевой сигнал дала глава ЦБ Э. Набиуллина, пообещав держать ставку высокой долго.""",
+    "abbrev": """📈 Бюджет и ОФЗ
+
+Минфин наращивает заимствования.
+
+**Аналитика:**
+Дефицит бюджета растёт с весны.
+По итогам 2025 г. Минфин разместит ОФЗ на 4 трлн руб. сверх плана, т.е. вдвое больше прошлого года.""",
+}
+
+
+def run_compact_check(main) -> list:
+    """_compact_to_fit при лимите на 20 символов меньше поста: каждая строка
+    результата — строка исходника (предложения не режутся на сокращениях)."""
+    rows = []
+    for name, post in COMPACT_CASES.items():
+        out = main._compact_to_fit(post, fits=lambda t: len(t) <= len(post) - 20)
+        source = set(post.split("\n"))
+        whole = out is not None and all(ln in source for ln in out.split("\n"))
+        rows.append({"case": name, "chars": f"{len(post)}→{len(out) if out else '-'}",
+                     "last_line": (out or "").split("\n")[-1][:48], "ok": "ok" if whole else "FAIL"})
+    return rows
+
+
+# ─── Проверка кластеризации ───────────────────────────────────────────────────
+def run_cluster_check(main) -> list:
+    """Каждый сюжет DUP_HEADLINES — ровно один кластер, без чужих новостей."""
+    now = datetime.now(timezone.utc).isoformat()
+    items = [{"title": title, "summary": summary, "link": f"https://{src}/news/{i}",
+              "published": now, "story": story}
+             for i, (story, src, title, summary) in enumerate(DUP_HEADLINES)]
+    started = time.perf_counter()
+    clusters = main._cluster_stories(items)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    rows = []
+    for story in sorted({x["story"] for x in items if x["story"]}):
+        own = [c for c in clusters if any(x["story"] == story for x in c["items"])]
+        foreign = sum(1 for c in own for x in c["items"] if x["story"] != story)
+        rows.append({"story": story, "items": sum(x["story"] == story for x in items),
+                     "clusters": len(own), "foreign": foreign,
+                     "ok": "ok" if len(own) == 1 and not foreign else "FAIL", "ms": elapsed_ms})
+    return rows
+
+
+# ─── Микробенчмарки ───────────────────────────────────────────────────────────
+def run_micro(main, cfg) -> list:
+    rnd = random.Random(cfg.seed)
+    post = fake_post(rnd, 900) + "\n— Подсчёт: 900 символов"
+    link = "https://www.rbc.ru/economics/17/10/2026/abc123?utm_source=rss&utm_medium=feed&from=main"
+    title = "Минфин разместил ОФЗ на 100 млрд рублей"
+    blob = "1929 Чёрный четверг — крах Нью-Йоркской фондовой биржи, начало Великой депрессии. " * 3
+    cases = [
+        ("_polish_and_to_html", lambda: main._polish_and_to_html(post)),
+        ("_render_caption", lambda: main._render_caption(post)),
+        ("_story_id", lambda: main._story_id(title, link)),
+        ("_score_fin_event", lambda: main._score_fin_event(blob)),
+    ]
+    rows = []
+    for name, fn in cases:
+        number, _ = timeit.Timer(fn).autorange()
+        best = min(timeit.repeat(fn, number=number, repeat=cfg.micro_repeat)) / number
+        rows.append({"name": name, "us_per_op": best * 1e6, "loops": number})
+    return rows
+
+
+def _table(rows: list, columns: list) -> str:
+    fmt = lambda v: f"{v:.3f}" if isinstance(v, float) else str(v)
+    widths = [max(len(c), *(len(fmt(r[c])) for r in rows)) for c in columns]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths))]
+    lines += ["  ".join(fmt(r[c]).ljust(w) for c, w in zip(columns, widths)) for r in rows]
+    return "\n".join(lines)
+
+
+def main_cli(argv=None):
+    p = argparse.ArgumentParser(description="Офлайн-бенчмарк MinFinTools")
+    p.add_argument("--runs", type=int, default=10, help="прогонов каждого вида")
+    p.add_argument("--kinds", default="news,rubric,history")
+    p.add_argument("--llm-latency", type=float, default=0.2, help="медиана ответа chat, с")
+    p.add_argument("--llm-len", type=int, default=750, help="средняя длина поста, символов")
+    p.add_argument("--llm-len-sd", type=int, default=120)
+    p.add_argument("--long-len", type=int, default=1080, help="длина поста в сценарии rubric_long")
+    p.add_argument("--image-latency", type=float, default=0.3)
+    p.add_argument("--image-kb", type=int, default=300)
+    p.add_argument("--tg-latency", type=float, default=0.05)
+    p.add_argument("--wiki-latency", type=float, default=0.05)
+    p.add_argument("--url-fail-rate", type=float, default=0.2, help="доля отказов sendPhoto по URL")
+    p.add_argument("--mirrors", type=int, default=0, help="каналов-зеркал (MIRROR_CHANNELS)")
+    p.add_argument("--flood-rate", type=float, default=0.0, help="доля ответов 429 RetryAfter")
+    p.add_argument("--feeds", type=int, default=3, help="лент на тему")
+    p.add_argument("--feed-items", type=int, default=20)
+    p.add_argument("--no-stream", dest="stream", action="store_false")
+    p.add_argument("--cold", action="store_true", help="сбрасывать кэши/хранилища перед каждым прогоном")
+    p.add_argument("--micro-only", action="store_true")
+    p.add_argument("--no-micro", action="store_true")
+    p.add_argument("--micro-repeat", type=int, default=5)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", help="дописать отчёт в файл (например, bench_output.txt)")
+    cfg = p.parse_args(argv)
+    cfg.kinds = [k.strip() for k in cfg.kinds.split(",") if k.strip()]
+
+    base = start_services(cfg)
+    main = import_main(cfg, base)
+    report = [f"# bench {datetime.now().isoformat(timespec='seconds')} "
+              f"runs={cfg.runs} stream={cfg.stream} cold={cfg.cold} llm_latency={cfg.llm_latency}"]
+    clusters = run_cluster_check(main)
+    report += ["", "## кластеризация (настоящие дубли заголовков)",
+               _table(clusters, ["story", "items", "clusters", "foreign", "ok", "ms"])]
+    compact = run_compact_check(main)
+    report += ["", "## ужатие (инициалы и сокращения)",
+               _table(compact, ["case", "chars", "last_line", "ok"])]
+    if not cfg.micro_only:
+        rows = run_pipeline(main, cfg)
+        report += ["", "## pipeline (на прогон)", _table(rows, [
+            "kind", "runs", "ok", "p50_s", "p95_s", "llm_calls", "image_calls", "streams_aborted",
+            "tg_url", "tg_file", "tg_file_id", "tg_retry_after", "kb_openai", "kb_telegram", "kb_feeds"])]
+    if not cfg.no_micro:
+        report += ["", "## micro", _table(run_micro(main, cfg), ["name", "us_per_op", "loops"])]
+    text = "\n".join(report) + "\n"
+    print(text)
+    if cfg.out:
+        with open(cfg.out, "a", encoding="utf-8") as f:
+            f.write(text + "\n")
+    # регрессия кластеризации или ужатия — ненулевой код выхода
+    return 1 if any(r["ok"] != "ok" for r in clusters + compact) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
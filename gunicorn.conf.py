@@ -0,0 +1,20 @@
+# Запуск под gunicorn: gunicorn -c gunicorn.conf.py main:app
+# Каждый воркер обслуживает HTTP и после старта запускает start_background():
+# прогрев клиентов и выборы лидера. APScheduler крутит только один процесс
+# (держатель DATA_DIR/locks/scheduler.lock), остальные подхватят, если он умрёт.
+# Статус /jobs/<id> живёт в памяти воркера, который принял /test, поэтому по
+# умолчанию воркер один (запросы параллелят потоки); WEB_CONCURRENCY>1 — только
+# если опрос /jobs не нужен.
+import os
+import threading
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+
+
+def post_worker_init(worker):
+    # приложение воркера уже импортировано — тот же модуль main, что обслуживает запросы
+    import main
+
+    threading.Thread(target=main.start_background, daemon=True, name="background").start()
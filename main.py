@@ -1,26 +1,83 @@
+import time
+_BOOT_STARTED = time.perf_counter()  # отсчёт старта процесса — для логов о запуске
+
 import os
 import re
 import json
-import time
 import html
 import random
+import bisect
 import hashlib
+import importlib.util
+import zlib
+import xml.etree.ElementTree as ET
 import logging
+import argparse
+import sys
+import socket
+import sqlite3
 import threading
+import uuid
 from io import BytesIO
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
 from time import mktime
 from datetime import datetime, timedelta
-from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, urljoin
 
 import pytz
-import httpx
-import feedparser
-import telegram
-from telegram.error import BadRequest
-from openai import OpenAI
-from apscheduler.schedulers.background import BackgroundScheduler
 from flask import Flask, request
 
+try:
+    import fcntl
+except ImportError:  # не POSIX (локальный запуск под Windows): процесс считается единственным
+    fcntl = None
+
+# ─── Ленивые зависимости ──────────────────────────────────────────────────────
+# openai, telegram, httpx, feedparser и APScheduler импортируются (а клиенты
+# строятся) при первом обращении: Flask отвечает на /ping сразу после старта.
+STARTUP_TIMINGS = {}  # что -> секунды (импорт модуля, сборка клиента)
+
+class LazyObject:
+    """
+    Заместитель модуля или клиента: factory() вызывается один раз при первом
+    обращении к атрибуту (потокобезопасно), дальше атрибуты берутся у готового
+    объекта. Время сборки — в STARTUP_TIMINGS и в лог.
+    """
+    __slots__ = ("_name", "_factory", "_obj", "_lock")
+    _UNSET = object()
+
+    def __init__(self, name: str, factory):
+        self._name = name
+        self._factory = factory
+        self._obj = LazyObject._UNSET
+        self._lock = threading.Lock()
+
+    def load(self):
+        obj = self._obj
+        if obj is LazyObject._UNSET:
+            with self._lock:
+                if self._obj is LazyObject._UNSET:
+                    started = time.perf_counter()
+                    self._obj = self._factory()
+                    STARTUP_TIMINGS[self._name] = round(time.perf_counter() - started, 3)
+                    logging.getLogger(__name__).info("⏱️ %s: %.3fs", self._name, STARTUP_TIMINGS[self._name])
+                obj = self._obj
+        return obj
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+def _lazy_module(name: str) -> LazyObject:
+    return LazyObject(f"import {name}", lambda: importlib.import_module(name))
+
+httpx = _lazy_module("httpx")
+feedparser = _lazy_module("feedparser")
+telegram = _lazy_module("telegram")
+telegram_error = _lazy_module("telegram.error")
+
 # ─── Настройки ─────────────────────────────────────────────────────────────────
 app = Flask(__name__)
 
@@ -30,6 +87,8 @@ logger = logging.getLogger(__name__)
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# свой Bot API сервер (или локальная заглушка bench.py); OpenAI берёт OPENAI_BASE_URL сам
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL") or None
 if not TELEGRAM_TOKEN:
     raise ValueError("TELEGRAM_TOKEN не задан в переменных окружения")
 if not CHANNEL_ID:
@@ -52,13 +111,197 @@ SEEN_MAX_ITEMS = int(os.getenv("SEEN_MAX_ITEMS", "1000"))
 # ➕ Новое: куда класть состояние ротации (на Volume)
 ROTATION_STATE_FILE = os.getenv("ROTATION_STATE_FILE", os.path.join(DATA_DIR, "rotation_state.json"))
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-bot = telegram.Bot(token=TELEGRAM_TOKEN)
-scheduler = BackgroundScheduler(timezone=pytz.timezone("Europe/Moscow"))
+# хранилище состояния: "sqlite" (WAL, по умолчанию) | "json" (прежние файлы)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite").lower()
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", os.path.join(DATA_DIR, "state.db"))
+POST_HISTORY_FILE = os.getenv("POST_HISTORY_FILE", os.path.join(DATA_DIR, "posts_history.jsonl"))
+SEEN_LOG_FILE = SEEN_NEWS_FILE + ".log"
+SEEN_COMPACT_EVERY = int(os.getenv("SEEN_COMPACT_EVERY", "200"))
+
+# параллельная загрузка RSS: дедлайн на одну ленту и на весь сбор (сек)
+RSS_FEED_TIMEOUT = float(os.getenv("RSS_FEED_TIMEOUT", "10"))
+RSS_TOTAL_TIMEOUT = float(os.getenv("RSS_TOTAL_TIMEOUT", "20"))
+RSS_MAX_WORKERS = int(os.getenv("RSS_MAX_WORKERS", "8"))
+# потоковый разбор лент: читаем тело кусками и бросаем после per_feed записей,
+# но не больше RSS_MAX_FEED_BYTES на ленту (full.rss с текстами статей — мегабайты)
+RSS_STREAM_PARSE = os.getenv("RSS_STREAM_PARSE", "1") == "1"
+RSS_MAX_FEED_BYTES = int(os.getenv("RSS_MAX_FEED_BYTES", str(2 * 1024 * 1024)))
+
+# кэш лент для условных GET (ETag / Last-Modified)
+FEED_CACHE_FILE = os.getenv("FEED_CACHE_FILE", os.path.join(DATA_DIR, "feed_cache.json"))
+FEED_CACHE_MAX_HOURS = int(os.getenv("FEED_CACHE_MAX_HOURS", "72"))
+FEED_CACHE_MAX_ITEMS = int(os.getenv("FEED_CACHE_MAX_ITEMS", "100"))
+
+# здоровье лент: после FEED_BREAKER_FAILURES ошибок подряд лента пропускается,
+# пауза растёт вдвое с каждым неудачным пробным запросом (до FEED_BREAKER_MAX_MIN)
+FEED_HEALTH_FILE = os.getenv("FEED_HEALTH_FILE", os.path.join(DATA_DIR, "feed_health.json"))
+FEED_BREAKER_FAILURES = int(os.getenv("FEED_BREAKER_FAILURES", "3"))
+FEED_BREAKER_BASE_MIN = float(os.getenv("FEED_BREAKER_BASE_MIN", "10"))
+FEED_BREAKER_MAX_MIN = float(os.getenv("FEED_BREAKER_MAX_MIN", "720"))
+
+# фоновый сбор лент в локальное хранилище новостей
+NEWS_STORE_FILE = os.getenv("NEWS_STORE_FILE", os.path.join(DATA_DIR, "news_store.json"))
+NEWS_STORE_MAX_HOURS = int(os.getenv("NEWS_STORE_MAX_HOURS", "48"))
+NEWS_INGEST_MINUTES = int(os.getenv("NEWS_INGEST_MINUTES", "10"))
+NEWS_INGEST_PER_FEED = int(os.getenv("NEWS_INGEST_PER_FEED", "5"))
+
+# выбор «самой нашумевшей»: "local" | "hybrid" (LLM разбивает ничьи) | "llm"
+NEWS_RANKER = os.getenv("NEWS_RANKER", "local").lower()
+# один сюжет: заголовки делят ≥ NEWS_CLUSTER_MIN_SHARED стемов и ≥ NEWS_CLUSTER_TITLE
+# от более короткого (у разных изданий разные лиды — по ним дубли почти не видны),
+# либо тексты почти совпадают (Жаккар по MinHash ≥ NEWS_CLUSTER_JACCARD — перепечатки;
+# у пересказов одного сюжета он 0.1–0.3, как и у разных сюжетов с общим словарём)
+NEWS_CLUSTER_TITLE = float(os.getenv("NEWS_CLUSTER_TITLE", "0.4"))
+NEWS_CLUSTER_MIN_SHARED = int(os.getenv("NEWS_CLUSTER_MIN_SHARED", "3"))
+NEWS_CLUSTER_JACCARD = float(os.getenv("NEWS_CLUSTER_JACCARD", "0.5"))
+NEWS_FRESH_HALFLIFE_H = float(os.getenv("NEWS_FRESH_HALFLIFE_H", "12"))
+NEWS_TIE_EPS = float(os.getenv("NEWS_TIE_EPS", "0.1"))
+NEWS_MINHASH_PERMS = 64
+
+# кэш ответов LLM для generate_post_text
+TEXT_MODEL = os.getenv("TEXT_MODEL", "gpt-4o")
+TEXT_TEMPERATURE = 0.6
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", os.path.join(DATA_DIR, "llm_cache"))
+LLM_CACHE_TTL_HOURS = int(os.getenv("LLM_CACHE_TTL_HOURS", "24"))
+LLM_CACHE_MAX_ITEMS = int(os.getenv("LLM_CACHE_MAX_ITEMS", "500"))
+LLM_CACHE_MEM_ITEMS = int(os.getenv("LLM_CACHE_MEM_ITEMS", "64"))
+
+# лимиты запросов к OpenAI в минуту на процесс (0 — без лимита); пакетный режим
+# задаёт свои через --rpm / --image-rpm
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "0"))
+OPENAI_IMAGE_RPM = float(os.getenv("OPENAI_IMAGE_RPM", "0"))
+
+# бюджет генерации одного поста
+PLAIN_TEXT_LIMIT = 1015
+GEN_MAX_CALLS = int(os.getenv("GEN_MAX_CALLS", "6"))
+GEN_MAX_TOKENS = int(os.getenv("GEN_MAX_TOKENS", "15000"))
+GEN_MAX_SECONDS = float(os.getenv("GEN_MAX_SECONDS", "150"))
+GEN_FIT_MAX_CALLS = int(os.getenv("GEN_FIT_MAX_CALLS", "3"))
+# ~2.5 символа кириллицы на токен → CAPTION_LIMIT/2 токенов хватает с запасом,
+# а заведомо длинный ответ обрывается, не тратя полную генерацию
+GEN_MAX_OUTPUT_TOKENS = int(os.getenv("GEN_MAX_OUTPUT_TOKENS", str(CAPTION_LIMIT // 2)))
+SHORTEN_TARGETS = (940, 900, 860, 820)
+TOO_LONG_HINT = (f"\n\nВАЖНО: предыдущий вариант вышел длиннее {CAPTION_LIMIT} символов — "
+                 "пиши заметно короче.")
+
+# стриминг: обрываем генерацию, как только подпись заведомо не влезет
+GEN_STREAM = os.getenv("GEN_STREAM", "1") == "1"
+GEN_STREAM_CHECK_EVERY = int(os.getenv("GEN_STREAM_CHECK_EVERY", "64"))
+# запас на то, что полировка ещё может убрать (строка «— Подсчёт: …», ###)
+GEN_STREAM_SLACK = int(os.getenv("GEN_STREAM_SLACK", "40"))
+# перелёт, который обычно снимает _compact_to_fit: такой стрим дочитываем и ужимаем
+# локально, а не обрываем (0 — обрывать сразу за GEN_STREAM_SLACK)
+GEN_COMPACT_MAX = int(os.getenv("GEN_COMPACT_MAX", "150"))
+
+# общий HTTP-клиент (RSS, Wikipedia, картинки)
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1"
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "90"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_BYTES = int(os.getenv("HTTP_MAX_BYTES", str(5 * 1024 * 1024)))
+HTTP_MAX_IMAGE_BYTES = int(os.getenv("HTTP_MAX_IMAGE_BYTES", str(15 * 1024 * 1024)))
+
+# дополнительные взвешенные словари (JSON) для KeywordScorer
+KEYWORD_VOCAB_FILE = os.getenv("KEYWORD_VOCAB_FILE", os.path.join(DATA_DIR, "keyword_vocabs.json"))
+
+# локальный индекс «В этот день в финансах»
+ONTHISDAY_FILE = os.getenv("ONTHISDAY_FILE", os.path.join(DATA_DIR, "onthisday.json"))
+ONTHISDAY_PREFETCH_DAYS = int(os.getenv("ONTHISDAY_PREFETCH_DAYS", "3"))
+ONTHISDAY_TTL_DAYS = int(os.getenv("ONTHISDAY_TTL_DAYS", "30"))
+ONTHISDAY_URL = os.getenv("ONTHISDAY_URL",
+                          "https://{lang}.wikipedia.org/api/rest_v1/feed/onthisday/events/{m}/{d}")
+
+# черновики к ближайшим слотам (pre-render)
+DRAFTS_DIR = os.getenv("DRAFTS_DIR", os.path.join(DATA_DIR, "drafts"))
+# темы, закреплённые за слотами (переживают перезапуск вместе с черновиками)
+PLANNED_TOPICS_FILE = os.getenv("PLANNED_TOPICS_FILE", os.path.join(DATA_DIR, "planned_topics.json"))
+PRERENDER_ENABLED = os.getenv("PRERENDER_ENABLED", "1") == "1"
+PRERENDER_AHEAD = int(os.getenv("PRERENDER_AHEAD", "2"))
+PRERENDER_MINUTES = int(os.getenv("PRERENDER_MINUTES", "10"))
+PRERENDER_LEAD_HOURS = float(os.getenv("PRERENDER_LEAD_HOURS", "6"))
+PRERENDER_GRACE_MIN = int(os.getenv("PRERENDER_GRACE_MIN", "15"))
+NEWS_DRAFT_LEAD_MIN = int(os.getenv("NEWS_DRAFT_LEAD_MIN", "45"))
+NEWS_DRAFT_MAX_AGE_MIN = int(os.getenv("NEWS_DRAFT_MAX_AGE_MIN", "60"))
+# после стольких неудачных попыток слот не пререндерим — он соберётся вживую
+PRERENDER_MAX_FAILURES = int(os.getenv("PRERENDER_MAX_FAILURES", "3"))
+
+# пакетная генерация черновиков (python main.py batch …): отдельно от слотовых
+BATCH_DIR = os.getenv("BATCH_DIR", os.path.join(DATA_DIR, "batch"))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+
+# фоновые задачи: общий пул, не больше JOB_TYPE_LIMIT задач одного типа разом
+# (переопределение по типам: JOB_TYPE_LIMITS="news=1,prerender=1"), дедлайны стадий
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "3"))
+JOB_TYPE_LIMIT = int(os.getenv("JOB_TYPE_LIMIT", "1"))
+JOB_TYPE_LIMITS = {k.strip(): int(v) for k, v in
+                   (p.split("=", 1) for p in os.getenv("JOB_TYPE_LIMITS", "").split(",") if "=" in p)}
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", "50"))
+JOB_STAGE_DEADLINES = {
+    "fetch": float(os.getenv("JOB_DEADLINE_FETCH", "60")),
+    "generate": float(os.getenv("JOB_DEADLINE_GENERATE", "180")),
+    "image": float(os.getenv("JOB_DEADLINE_IMAGE", "150")),
+    "publish": float(os.getenv("JOB_DEADLINE_PUBLISH", "120")),
+}
+
+# журнал прогонов: одна JSONL-строка на задачу (стадии и спаны), ротация по размеру
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(DATA_DIR, "runs.jsonl"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(1024 * 1024)))
+
+# несколько реплик/воркеров на одном Volume: flock-файлы в LOCKS_DIR. Планировщик
+# крутит только лидер (держатель scheduler.lock), остальные пробуют перехватить
+# лидерство раз в LEADER_RETRY_SECONDS
+LOCKS_DIR = os.getenv("LOCKS_DIR", os.path.join(DATA_DIR, "locks"))
+LEADER_RETRY_SECONDS = float(os.getenv("LEADER_RETRY_SECONDS", "15"))
+
+# каналы-зеркала: тот же пост уходит и туда; фото грузится один раз (в CHANNEL_ID),
+# дальше — по file_id. Лимиты Bot API: ~30 сообщений/с на бота, ~20/мин в один чат
+MIRROR_CHANNELS = [c.strip() for c in os.getenv("MIRROR_CHANNELS", "").split(",") if c.strip()]
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+TG_CHAT_RATE_PER_MIN = float(os.getenv("TG_CHAT_RATE_PER_MIN", "18"))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_RETRY_AFTER_MAX = int(os.getenv("TG_RETRY_AFTER_MAX", "3"))
+TG_FANOUT_WORKERS = int(os.getenv("TG_FANOUT_WORKERS", "4"))
+
+client = LazyObject("openai client", lambda: importlib.import_module("openai").OpenAI(api_key=OPENAI_API_KEY))
+
+def _make_bot():
+    from telegram.utils.request import Request
+    # пул соединений бота: основной канал + параллельная рассылка по зеркалам
+    return telegram.Bot(token=TELEGRAM_TOKEN, base_url=TELEGRAM_API_URL,
+                        request=Request(con_pool_size=TG_FANOUT_WORKERS + 2))
+
+bot = LazyObject("telegram bot", _make_bot)
+
+# общий пул HTTP для RSS, Wikipedia и картинок: keep-alive вместо TCP/TLS на каждый запрос
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None  # httpx[http2]
+http = LazyObject("http client", lambda: httpx.Client(
+    http2=HTTP2_ENABLED and HTTP2_AVAILABLE,
+    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+    timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    follow_redirects=True,
+    headers={"User-Agent": "Mozilla/5.0"},
+))
+scheduler = LazyObject("apscheduler", lambda: importlib.import_module(
+    "apscheduler.schedulers.background").BackgroundScheduler(timezone=pytz.timezone("Europe/Moscow")))
 
 # блокировка на случай одновременных вызовов (scheduler + /test)
 ROT_LOCK = threading.Lock()
 
+# общий пул для загрузки лент (не блокируемся на зависших источниках)
+RSS_POOL = ThreadPoolExecutor(max_workers=RSS_MAX_WORKERS, thread_name_prefix="rss")
+
+# пул фоновых задач (слоты расписания, /test, пререндер) — запросы Flask не ждут
+JOB_POOL = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+# рассылка поста по каналам-зеркалам
+FANOUT_POOL = ThreadPoolExecutor(max_workers=TG_FANOUT_WORKERS, thread_name_prefix="tg")
+
 NEGATIVE_SUFFIX = (
     "No text or numbers anywhere. "
     "No letters, words, digits, currency signs or tickers. "
@@ -86,18 +329,40 @@ def manual_test():
         return "Forbidden", 403
 
     kind = request.args.get("type", "news")  # "news" | "rubric" | "history"
-    try:
-        if kind == "rubric":
-            scheduled_rubric_post()
-            return "✅ Отправлен следующий рубричный пост по ротации", 200
-        elif kind == "history":
-            scheduled_history_post()
-            return "✅ Отправлен исторический пост «В этот день в финансах»", 200
-        else:
-            scheduled_news_post()
-            return "✅ Отправлен следующий новостной пост по ротации", 200
-    except Exception as e:
-        return f"❌ Ошибка: {e}", 500
+    if kind not in ("rubric", "history"):
+        kind = "news"
+    # пост собирается минуты — не держим запрос, а отдаём id фоновой задачи;
+    # черновики и темы слотов не трогаем — они для публикаций по расписанию
+    job, coalesced = submit_job(kind, lambda: manual_post(kind), key=f"{kind}:manual")
+    return {"job_id": job["id"], "type": kind, "status": job["status"],
+            "coalesced": coalesced, "url": f"/jobs/{job['id']}"}, 202
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    token = request.args.get("token"); expected = os.getenv("TEST_TOKEN")
+    if expected and token != expected: return "Forbidden", 403
+    view = _job_view(job_id)
+    if view is None:
+        return {"job_id": job_id, "error": "not found"}, 404
+    return view, 200
+
+@app.route("/metrics")
+def metrics():
+    token = request.args.get("token"); expected = os.getenv("TEST_TOKEN")
+    if expected and token != expected: return "Forbidden", 403
+    return _metrics_text(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/debug/runs")
+def debug_runs():
+    token = request.args.get("token"); expected = os.getenv("TEST_TOKEN")
+    if expected and token != expected: return "Forbidden", 403
+    run_id = request.args.get("id")
+    if run_id:
+        run = next((r for r in _read_runs(10 ** 6) if r.get("id") == run_id), None)
+        return (run, 200) if run else ({"id": run_id, "error": "not found"}, 404)
+    # нечисловое n → по умолчанию, иначе 1..500 — чтобы ответ не разрастался
+    limit = max(1, min(request.args.get("n", 20, type=int), 500))
+    return {"file": TRACE_FILE, "runs": [_run_breakdown(r) for r in _read_runs(limit)]}, 200
 
 @app.route("/debug/ls")
 def debug_ls():
@@ -114,6 +379,50 @@ def debug_ls():
     except Exception as e:
         return {"DATA_DIR": DATA_DIR, "error": str(e)}, 500
 
+@app.route("/debug/feeds")
+def debug_feeds():
+    token = request.args.get("token"); expected = os.getenv("TEST_TOKEN")
+    if expected and token != expected: return "Forbidden", 403
+    with FEED_CACHE_LOCK:
+        cache = _feed_cache()
+        feeds = {url: {k: v for k, v in rec.items() if k != "entries"}
+                 for url, rec in cache.items()}
+        return {"stats": dict(FEED_CACHE_STATS), "feeds": feeds}, 200
+
+@app.route("/debug/feed-health")
+def debug_feed_health():
+    token = request.args.get("token"); expected = os.getenv("TEST_TOKEN")
+    if expected and token != expected: return "Forbidden", 403
+    return {"file": FEED_HEALTH_FILE, "feeds": _feed_health_view()}, 200
+
+@app.route("/debug/llm")
+def debug_llm():
+    token = request.args.get("token"); expected = os.getenv("TEST_TOKEN")
+    if expected and token != expected: return "Forbidden", 403
+    with LLM_CACHE_LOCK:
+        stats = dict(LLM_CACHE_STATS)
+        mem_items = len(_LLM_MEM)
+    lookups = stats["mem_hits"] + stats["disk_hits"] + stats["misses"]
+    hit_rate = (stats["mem_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+    return {"enabled": LLM_CACHE_ENABLED, "stats": stats, "hit_rate": round(hit_rate, 3),
+            "mem_items": mem_items, "dir": LLM_CACHE_DIR}, 200
+
+@app.route("/debug/leader")
+def debug_leader():
+    token = request.args.get("token"); expected = os.getenv("TEST_TOKEN")
+    if expected and token != expected: return "Forbidden", 403
+    return {"pid": os.getpid(), "leader": _LEADER_FILE is not None, "holder": _leader_info()}, 200
+
+@app.route("/debug/http")
+def debug_http():
+    token = request.args.get("token"); expected = os.getenv("TEST_TOKEN")
+    if expected and token != expected: return "Forbidden", 403
+    with HTTP_STATS_LOCK:
+        stats = dict(HTTP_STATS)
+    reused = max(0, stats["requests"] - stats["errors"] - stats["connections"])
+    return {"http2": HTTP2_ENABLED and HTTP2_AVAILABLE, "stats": stats,
+            "reuse_rate": round(reused / stats["requests"], 3) if stats["requests"] else 0.0}, 200
+
 @app.route("/debug/file")
 def debug_file():
     token = request.args.get("token"); expected = os.getenv("TEST_TOKEN")
@@ -125,6 +434,277 @@ def debug_file():
         return {"exists": True, "path": path, "content": f.read()}, 200
 
 # ─── Утилиты ──────────────────────────────────────────────────────────────────
+# Метрики в памяти процесса (формат Prometheus на /metrics). На горячем пути —
+# только захват лока и пара операций со словарём.
+METRIC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+METRICS = {
+    # имя -> (тип, описание)
+    "rss_fetch_seconds": ("histogram", "Загрузка и разбор одной RSS-ленты"),
+    "rss_fetch_failures_total": ("counter", "Ошибки загрузки RSS-ленты"),
+    "rss_feed_skipped_total": ("counter", "Ленты, пропущенные из-за открытого предохранителя"),
+    "openai_request_seconds": ("histogram", "Длительность запроса к OpenAI"),
+    "openai_tokens_total": ("counter", "Потраченные токены OpenAI (у оборванного стрима — оценка)"),
+    "openai_retries_total": ("counter", "Отклонённые кандидаты, после которых нужен новый вызов LLM"),
+    "telegram_send_seconds": ("histogram", "Отправка фото с подписью в Telegram"),
+    "publish_total": ("counter", "Публикации по способу: url / file (фолбэк) / failed"),
+    "mirror_total": ("counter", "Отправки в каналы-зеркала: file_id / url / file / failed"),
+    "telegram_retry_after_total": ("counter", "Ответы Telegram RetryAfter (flood control)"),
+    "seen_lookups_total": ("counter", "Проверки сюжета по журналу «уже было»"),
+    "job_stage_seconds": ("histogram", "Длительность стадий фоновых задач"),
+    "jobs_total": ("counter", "Завершённые фоновые задачи по типу и статусу"),
+}
+METRICS_LOCK = threading.Lock()
+_METRIC_VALUES = {}  # (имя, ((метка, значение), …)) -> число | [счётчики бакетов, сумма, количество]
+
+def metric_inc(name: str, value: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK:
+        _METRIC_VALUES[key] = _METRIC_VALUES.get(key, 0) + value
+
+def metric_observe(name: str, value: float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    idx = bisect.bisect_left(METRIC_BUCKETS, value)
+    with METRICS_LOCK:
+        hist = _METRIC_VALUES.get(key)
+        if hist is None:
+            hist = _METRIC_VALUES[key] = [[0] * len(METRIC_BUCKETS), 0.0, 0]
+        if idx < len(METRIC_BUCKETS):
+            hist[0][idx] += 1
+        hist[1] += value
+        hist[2] += 1
+
+@contextmanager
+def metric_timer(name: str, **labels):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        metric_observe(name, time.monotonic() - started, **labels)
+
+def _metric_labels(pairs) -> str:
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+def _metrics_text() -> str:
+    """Все метрики в текстовом формате Prometheus (+ счётчики кэшей и HTTP-пула)."""
+    with METRICS_LOCK:
+        values = {key: ([list(v[0]), v[1], v[2]] if isinstance(v, list) else v)
+                  for key, v in _METRIC_VALUES.items()}
+    # готовые счётчики кэшей — снимаем на скрейпе, горячий путь не трогаем
+    for name, lock, stats in (("llm_cache_events_total", LLM_CACHE_LOCK, LLM_CACHE_STATS),
+                              ("feed_cache_events_total", FEED_CACHE_LOCK, FEED_CACHE_STATS),
+                              ("http_client_events_total", HTTP_STATS_LOCK, HTTP_STATS)):
+        with lock:
+            for event, n in stats.items():
+                values[(name, (("event", event),))] = n
+    helps = dict(METRICS, llm_cache_events_total=("counter", "Кэш ответов LLM: попадания/промахи"),
+                 feed_cache_events_total=("counter", "Кэш RSS: попадания (304)/промахи и байты"),
+                 http_client_events_total=("counter", "Общий HTTP-пул: запросы, соединения, байты"))
+    lines = []
+    for name, (kind, help_text) in helps.items():
+        series = sorted(((labels, v) for (n, labels), v in values.items() if n == name),
+                        key=lambda s: s[0])
+        if not series:
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for labels, v in series:
+            if kind != "histogram":
+                lines.append(f"{name}{_metric_labels(labels)} {v}")
+                continue
+            buckets, total, count = v
+            acc = 0
+            for le, n in zip(METRIC_BUCKETS, buckets):
+                acc += n
+                lines.append(f"{name}_bucket{_metric_labels(labels + (('le', le),))} {acc}")
+            lines.append(f"{name}_bucket{_metric_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_metric_labels(labels)} {round(total, 6)}")
+            lines.append(f"{name}_count{_metric_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, запас не больше burst."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout: float = None) -> bool:
+        """Берёт токен, при необходимости ждёт. False — не дождались за timeout."""
+        deadline = time.monotonic() + timeout if timeout not in (None, float("inf")) else None
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait_s = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait_s > deadline:
+                return False
+            time.sleep(wait_s)
+
+    def refund(self):
+        """Вернуть взятый токен, если действие так и не состоялось."""
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    def pause(self, seconds: float):
+        """RetryAfter: уводим ведро в минус — следующий токен появится через seconds."""
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+HTTP_STATS_LOCK = threading.Lock()
+HTTP_STATS = {"requests": 0, "connections": 0, "tls_handshakes": 0, "http2": 0,
+              "bytes": 0, "capped": 0, "errors": 0}
+
+def _http_trace(event: str, info: dict):
+    """Трассировка httpcore: считаем новые соединения, чтобы видеть переиспользование."""
+    if not event.endswith(".started"):
+        return
+    with HTTP_STATS_LOCK:
+        if event == "connection.connect_tcp.started":
+            HTTP_STATS["connections"] += 1
+        elif event == "connection.start_tls.started":
+            HTTP_STATS["tls_handshakes"] += 1
+        elif event == "http2.send_request_headers.started":
+            HTTP_STATS["http2"] += 1
+
+def http_get(url: str, headers=None, timeout=None, max_bytes=None, deadline=None, on_chunk=None):
+    """
+    GET через общий пул `http`. Тело читается потоково с лимитом max_bytes
+    (по умолчанию HTTP_MAX_BYTES) и необязательным дедлайном (time.monotonic()).
+    on_chunk(chunk) получает куски тела по мере загрузки; вернул True — остаток
+    не качаем (соединение закрывается), body — то, что успели прочитать.
+    С on_chunk заявленный Content-Length не проверяем: где остановиться, решает он,
+    max_bytes остаётся страховкой по фактически прочитанному.
+    Возвращает (response, body); у 304 тело пустое. Статус не проверяет.
+    """
+    max_bytes = HTTP_MAX_BYTES if max_bytes is None else max_bytes
+    with HTTP_STATS_LOCK:
+        HTTP_STATS["requests"] += 1
+    try:
+        with http.stream("GET", url, headers=headers, timeout=timeout or httpx.USE_CLIENT_DEFAULT,
+                         extensions={"trace": _http_trace}) as resp:
+            chunks, size = [], 0
+            declared = int(resp.headers.get("content-length") or 0)
+            if on_chunk is None and declared > max_bytes:
+                raise _capped(url, max_bytes)
+            if resp.status_code != 304:
+                for chunk in resp.iter_bytes():
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise _capped(url, max_bytes)
+                    if deadline and time.monotonic() > deadline:
+                        raise TimeoutError(f"deadline exceeded for {url}")
+                    chunks.append(chunk)
+                    if on_chunk is not None and on_chunk(chunk):
+                        break
+        with HTTP_STATS_LOCK:
+            HTTP_STATS["bytes"] += size
+        return resp, b"".join(chunks)
+    except Exception:
+        with HTTP_STATS_LOCK:
+            HTTP_STATS["errors"] += 1
+        raise
+
+class KeywordScorer:
+    """
+    Взвешенный словарь подстрок, собранный один раз в общий regex.
+    Каждый термин даёт свой вес, если встречается в тексте (сколько раз — неважно),
+    как и последовательные `if w in t` по спискам. Regex собран как префиксное
+    дерево; поиск перезапускается со следующей позиции после каждого совпадения,
+    так что находится самый длинный термин с каждой позиции, а остальные
+    совпавшие там же — его префиксы.
+    """
+
+    def __init__(self, weights: dict):
+        self.weights = {t.lower(): w for t, w in weights.items() if t}
+        terms = sorted(self.weights)
+        self._re = re.compile(self._trie_pattern(terms)) if terms else None
+        self._prefixes = {t: [p for p in terms if t.startswith(p)] for t in terms}
+
+    @staticmethod
+    def _trie_pattern(terms: list) -> str:
+        """Префиксное дерево → regex без перебора альтернатив на каждой позиции;
+        жадные `?` дают самое длинное совпадение по пути."""
+        trie = {}
+        for term in terms:
+            node = trie
+            for ch in term:
+                node = node.setdefault(ch, {})
+            node[""] = True
+
+        def build(node):
+            end = node.get("") is True
+            branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+            if not branches:
+                return ""
+            body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+            if end:
+                return ("(?:" + body + ")?") if len(branches) == 1 else body + "?"
+            return body
+
+        return build(trie)
+
+    @classmethod
+    def from_lists(cls, *weighted_lists) -> "KeywordScorer":
+        """(вес, [термины]), …: вес термина из нескольких списков суммируется."""
+        weights = {}
+        for weight, terms in weighted_lists:
+            for term in terms:
+                weights[term] = weights.get(term, 0) + weight
+        return cls(weights)
+
+    def _scan(self, text: str):
+        """Самое длинное совпадение с каждой позиции, где начинается термин."""
+        search, pos = self._re.search, 0
+        while True:
+            m = search(text, pos)
+            if m is None:
+                return
+            yield m
+            pos = m.start() + 1
+
+    def matches(self, text: str) -> set:
+        found = set()
+        if self._re is None:
+            return found
+        for m in self._scan((text or "").lower()):
+            found.update(self._prefixes[m.group()])
+        return found
+
+    def score(self, text: str) -> int:
+        return sum(self.weights[t] for t in self.matches(text))
+
+    def explain(self, text: str):
+        """(score, отсортированные совпавшие термины) — для отладки."""
+        found = self.matches(text)
+        return sum(self.weights[t] for t in found), sorted(found)
+
+    def score_many(self, texts: list) -> list:
+        """Пакет текстов за один проход regex по склейке через \\0 → [(score, terms)]."""
+        texts = [(t or "").lower() for t in texts]
+        found = [set() for _ in texts]
+        if self._re is not None and texts:
+            starts, pos = [], 0
+            for t in texts:
+                starts.append(pos)
+                pos += len(t) + 1
+            for m in self._scan("\0".join(texts)):
+                found[bisect.bisect_right(starts, m.start()) - 1].update(self._prefixes[m.group()])
+        return [(sum(self.weights[t] for t in f), sorted(f)) for f in found]
+
+def _capped(url: str, max_bytes: int) -> ValueError:
+    with HTTP_STATS_LOCK:
+        HTTP_STATS["capped"] += 1
+    return ValueError(f"response from {url} exceeds {max_bytes} bytes")
+
 def clean_html(raw_html: str) -> str:
     return re.sub(re.compile('<.*?>'), '', raw_html or "")
 
@@ -146,149 +726,760 @@ def _story_id(title: str, link: str) -> str:
     base = re.sub(r"[^\w\s/.\-]+", "", base)
     return hashlib.sha1(base.encode("utf-8")).hexdigest()[:16]
 
-def _load_seen() -> dict:
-    if os.path.exists(SEEN_NEWS_FILE):
-        try:
-            with open(SEEN_NEWS_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            pass
-    return {}
+# ➕ Новое: координация процессов (реплики / воркеры gunicorn на одном DATA_DIR)
+_IPC_THREAD_LOCKS = {}  # имя -> threading.Lock
+_IPC_GUARD = threading.Lock()
+_LEADER_FILE = None  # открытый scheduler.lock с удерживаемым flock, пока процесс жив
 
-def _save_seen(seen: dict):
+@contextmanager
+def interprocess_lock(name: str):
+    """
+    Эксклюзивная блокировка name для всех процессов на этом DATA_DIR
+    (fcntl.flock на LOCKS_DIR/<name>.lock) и для потоков текущего процесса.
+    Ядро снимает flock при смерти процесса — «зависших» блокировок не бывает.
+    """
+    with _IPC_GUARD:
+        thread_lock = _IPC_THREAD_LOCKS.setdefault(name, threading.Lock())
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(LOCKS_DIR, exist_ok=True)
+        with open(os.path.join(LOCKS_DIR, f"{name}.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def try_become_leader() -> bool:
+    """Неблокирующая попытка занять scheduler.lock. Лидер держит его до выхода процесса."""
+    global _LEADER_FILE
+    if _LEADER_FILE is not None or fcntl is None:
+        return True
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+    f = open(os.path.join(LOCKS_DIR, "scheduler.lock"), "a+")
     try:
-        os.makedirs(os.path.dirname(SEEN_NEWS_FILE) or DATA_DIR, exist_ok=True)  # ➕ ensure dir
-        with open(SEEN_NEWS_FILE, "w", encoding="utf-8") as f:
-            json.dump(seen, f, ensure_ascii=False)
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps({"pid": os.getpid(), "host": socket.gethostname(), "since": time.time()}))
+    f.flush()
+    _LEADER_FILE = f
+    return True
+
+def _leader_info():
+    """Кто держит лидерство (pid/host/since) — по содержимому scheduler.lock."""
+    try:
+        with open(os.path.join(LOCKS_DIR, "scheduler.lock"), "r") as f:
+            return json.loads(f.read() or "null")
     except Exception:
-        pass
+        return None
 
-def _prune_seen(seen: dict):
-    now = time.time()
-    cutoff = now - SEEN_MAX_DAYS * 86400
-    # по времени
-    for k in list(seen.keys()):
-        if seen[k] < cutoff:
-            del seen[k]
-    # по размеру
-    if len(seen) > SEEN_MAX_ITEMS:
-        keep = dict(sorted(seen.items(), key=lambda kv: kv[1], reverse=True)[:SEEN_MAX_ITEMS])
-        seen.clear()
-        seen.update(keep)
+def _file_version(path: str):
+    """(inode, mtime, размер) файла или None: меняется, когда файл переписал кто угодно."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
 
-def _mark_seen(story_id: str):
-    seen = _load_seen()
-    seen[story_id] = time.time()
-    _prune_seen(seen)
-    _save_seen(seen)
+class SharedJsonStore:
+    """
+    dict «ключ → запись» в JSON-файле на DATA_DIR, общий для процессов.
+    data() перечитывает файл, если его переписал другой процесс; свои ещё
+    не сохранённые ключи (touch) при этом не теряются. save() — под
+    interprocess_lock: свежая копия с диска + свои ключи → атомарная запись.
+    Потоки процесса, как и раньше, сериализует свой *_LOCK вызывающего.
+    """
 
-def _is_seen(story_id: str) -> bool:
-    return story_id in _load_seen()
+    def __init__(self, path: str, lock_name: str, what: str):
+        self.path, self.lock_name, self.what = path, lock_name, what
+        self._data = None
+        self._version = None
+        self._dirty = set()  # ключи, изменённые здесь после последнего save()
 
-# ➕ Новое: персистентная ротация индексов
-def _load_rotation_state() -> dict:
-    try:
-        with open(ROTATION_STATE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return data if isinstance(data, dict) else {}
-    except Exception:
-        return {}
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+                return data if isinstance(data, dict) else {}
+        except Exception:
+            return {}
+
+    def data(self) -> dict:
+        version = _file_version(self.path)
+        if self._data is None or version != self._version:
+            fresh = self._read()
+            for key in self._dirty:
+                if key in self._data:
+                    fresh[key] = self._data[key]
+                else:
+                    fresh.pop(key, None)
+            self._data, self._version = fresh, version
+        return self._data
+
+    def touch(self, key: str):
+        """Запись key изменена в этом процессе — при сохранении она главнее дисковой."""
+        self._dirty.add(key)
+
+    def save(self, prune=None):
+        """prune(data) — чистка перед записью (уже по слитой с диском копии)."""
+        with interprocess_lock(self.lock_name):
+            data = self.data()
+            if prune:
+                prune(data)
+            self._write(data)
+
+    def update(self, fn):
+        """Одна правка сразу на диск: свежая копия → fn(data) → запись, всё под блокировкой."""
+        with interprocess_lock(self.lock_name):
+            data = self.data()
+            fn(data)
+            self._write(data)
+
+    def clear(self):
+        """Очистить и файл, и память (bench --cold, ручной сброс)."""
+        with interprocess_lock(self.lock_name):
+            self._data, self._dirty = {}, set()
+            self._write(self._data)
+
+    def _write(self, data: dict):
+        """Вызывать под interprocess_lock(self.lock_name)."""
+        try:
+            os.makedirs(os.path.dirname(self.path) or DATA_DIR, exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)  # атомарная запись
+            self._version = _file_version(self.path)
+            self._dirty.clear()
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить {self.what}: {e}")
+
+# ➕ Новое: хранилище состояния (ротация, «уже было», история постов)
+class JsonStateBackend:
+    """
+    Прежний формат на Volume: rotation_state.json + seen_news.json.
+    «Уже было» пишется в append-only лог (seen_news.json.log), который
+    раз в SEEN_COMPACT_EVERY записей сворачивается в снапшот.
+    Изменения файлов — под interprocess_lock: процессы на одном Volume не теряют записи.
+    """
+
+    def __init__(self):
+        self._log_lines = 0
+
+    # ротация
+    def _load_rotation_state(self) -> dict:
+        try:
+            with open(ROTATION_STATE_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+                return data if isinstance(data, dict) else {}
+        except Exception:
+            return {}
+
+    def _save_rotation_state(self, state: dict):
+        try:
+            os.makedirs(os.path.dirname(ROTATION_STATE_FILE) or DATA_DIR, exist_ok=True)  # ➕ ensure dir
+            tmp = f"{ROTATION_STATE_FILE}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp, ROTATION_STATE_FILE)  # атомарная запись
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить состояние ротации: {e}")
+
+    def next_index(self, kind: str, total: int, avoid_key: str = None, names: list = None) -> int:
+        with ROT_LOCK, interprocess_lock("rotation"):
+            state = self._load_rotation_state()
+            key = f"{kind}_index"
+            idx = int(state.get(key, 0)) % total
+            # страховка от двух одинаковых подряд (для рубрик)
+            if avoid_key and names and state.get(avoid_key) == names[idx]:
+                idx = (idx + 1) % total
+            state[key] = (idx + 1) % total
+            if avoid_key and names:
+                state[avoid_key] = names[idx]
+            self._save_rotation_state(state)
+            return idx
+
+    # «уже было»
+    def load_seen(self) -> dict:
+        seen = {}
+        if os.path.exists(SEEN_NEWS_FILE):
+            try:
+                with open(SEEN_NEWS_FILE, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                    if isinstance(data, dict):
+                        seen.update(data)
+            except Exception:
+                pass
+        lines = 0
+        if os.path.exists(SEEN_LOG_FILE):
+            try:
+                with open(SEEN_LOG_FILE, "r", encoding="utf-8") as f:
+                    for line in f:
+                        sid, _, ts = line.strip().partition("\t")
+                        try:
+                            seen[sid] = float(ts)
+                            lines += 1
+                        except ValueError:
+                            continue  # недописанная строка после падения
+            except Exception:
+                pass
+        self._log_lines = lines
+        return seen
+
+    def _compact_seen(self, seen: dict):
+        try:
+            os.makedirs(os.path.dirname(SEEN_NEWS_FILE) or DATA_DIR, exist_ok=True)  # ➕ ensure dir
+            tmp = f"{SEEN_NEWS_FILE}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(seen, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, SEEN_NEWS_FILE)  # атомарная запись
+            open(SEEN_LOG_FILE, "w").close()
+            self._log_lines = 0
+        except Exception as e:
+            logger.warning(f"Не удалось сжать seen-лог: {e}")
+
+    def add_seen(self, story_id: str, ts: float, seen: dict, evicted: list):
+        """Вызывается под SEEN_LOCK; seen — актуальный индекс после вытеснения."""
+        with interprocess_lock("seen"):
+            if self._log_lines + 1 >= SEEN_COMPACT_EVERY:
+                # в снапшот — и то, что успели дописать другие процессы
+                merged = self.load_seen()
+                merged.update(seen)
+                merged = dict(sorted(merged.items(), key=lambda kv: kv[1]))
+                _prune_seen(merged)
+                self._compact_seen(merged)
+                return
+            try:
+                os.makedirs(os.path.dirname(SEEN_LOG_FILE) or DATA_DIR, exist_ok=True)
+                with open(SEEN_LOG_FILE, "a", encoding="utf-8") as f:
+                    f.write(f"{story_id}\t{ts}\n")
+                    f.flush()
+                    os.fsync(f.fileno())  # один fsync на новостной прогон
+                self._log_lines += 1
+            except Exception as e:
+                logger.warning(f"Не удалось записать seen-лог: {e}")
+
+    def seen_version(self):
+        """Меняется, когда seen-файлы переписал кто угодно (в т.ч. другой процесс)."""
+        version = []
+        for path in (SEEN_NEWS_FILE, SEEN_LOG_FILE):
+            try:
+                st = os.stat(path)
+                version.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def drop_seen(self, evicted: list):
+        """Снапшот и так пишется из уже вытесненного индекса (_compact_seen) — делать нечего."""
+
+    # история постов
+    def record_post(self, post: dict):
+        try:
+            os.makedirs(os.path.dirname(POST_HISTORY_FILE) or DATA_DIR, exist_ok=True)
+            with open(POST_HISTORY_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps(post, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.warning(f"Не удалось записать историю постов: {e}")
+
+
+class SqliteStateBackend:
+    """
+    SQLite в режиме WAL: kv (индексы ротации), seen, posts.
+    Каждое изменение — отдельная транзакция BEGIN IMMEDIATE. При первом
+    запуске импортирует rotation_state.json и seen_news.json (+ лог).
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS seen (story_id TEXT PRIMARY KEY, ts REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS seen_ts ON seen (ts)",
+        "CREATE TABLE IF NOT EXISTS posts ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, kind TEXT,"
+        " topic TEXT, title TEXT, caption TEXT, sent_as TEXT)",
+    )
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or DATA_DIR, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for stmt in self.SCHEMA:
+            self._db.execute(stmt)
+        self._migrate_json()
+
+    @contextmanager
+    def _tx(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _migrate_json(self):
+        with self._tx() as db:
+            if db.execute("SELECT 1 FROM kv WHERE key='migrated_json'").fetchone():
+                return
+            legacy = JsonStateBackend()
+            rotation = legacy._load_rotation_state()
+            for key, value in rotation.items():
+                db.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                           (key, json.dumps(value, ensure_ascii=False)))
+            seen = legacy.load_seen()
+            db.executemany("INSERT OR REPLACE INTO seen (story_id, ts) VALUES (?, ?)",
+                           [(k, float(v)) for k, v in seen.items()])
+            db.execute("INSERT INTO kv (key, value) VALUES ('migrated_json', ?)",
+                       (json.dumps(time.time()),))
+        if rotation or seen:
+            logger.info("🗃️ Состояние перенесено из JSON в SQLite: ротация=%d, seen=%d",
+                        len(rotation), len(seen))
+
+    @staticmethod
+    def _get(db, key: str, default=None):
+        row = db.execute("SELECT value FROM kv WHERE key=?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    @staticmethod
+    def _set(db, key: str, value):
+        db.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                   (key, json.dumps(value, ensure_ascii=False)))
+
+    def next_index(self, kind: str, total: int, avoid_key: str = None, names: list = None) -> int:
+        with self._tx() as db:
+            key = f"{kind}_index"
+            idx = int(self._get(db, key, 0)) % total
+            # страховка от двух одинаковых подряд (для рубрик)
+            if avoid_key and names and self._get(db, avoid_key) == names[idx]:
+                idx = (idx + 1) % total
+            self._set(db, key, (idx + 1) % total)
+            if avoid_key and names:
+                self._set(db, avoid_key, names[idx])
+            return idx
+
+    def load_seen(self) -> dict:
+        with self._lock:
+            return dict(self._db.execute("SELECT story_id, ts FROM seen ORDER BY ts"))
+
+    def seen_version(self):
+        """PRAGMA data_version растёт, только когда коммитят другие соединения (процессы)."""
+        with self._lock:
+            return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def add_seen(self, story_id: str, ts: float, seen: dict, evicted: list):
+        try:
+            with self._tx() as db:
+                db.execute("INSERT OR REPLACE INTO seen (story_id, ts) VALUES (?, ?)", (story_id, ts))
+                if evicted:
+                    db.executemany("DELETE FROM seen WHERE story_id=?", [(k,) for k in evicted])
+        except Exception as e:
+            logger.warning(f"Не удалось записать seen в SQLite: {e}")
+
+    def drop_seen(self, evicted: list):
+        """Вытесненное из индекса при загрузке — удаляем и из таблицы, чтобы она не росла."""
+        try:
+            with self._tx() as db:
+                db.executemany("DELETE FROM seen WHERE story_id=?", [(k,) for k in evicted])
+        except Exception as e:
+            logger.warning(f"Не удалось почистить seen в SQLite: {e}")
 
-def _save_rotation_state(state: dict):
+    def record_post(self, post: dict):
+        try:
+            with self._tx() as db:
+                db.execute(
+                    "INSERT INTO posts (ts, kind, topic, title, caption, sent_as)"
+                    " VALUES (:ts, :kind, :topic, :title, :caption, :sent_as)",
+                    {k: post.get(k) for k in ("ts", "kind", "topic", "title", "caption", "sent_as")})
+        except Exception as e:
+            logger.warning(f"Не удалось записать историю постов: {e}")
+
+
+def _make_state_backend():
+    if STATE_BACKEND == "json":
+        return JsonStateBackend()
     try:
-        os.makedirs(os.path.dirname(ROTATION_STATE_FILE) or DATA_DIR, exist_ok=True)  # ➕ ensure dir
-        tmp = ROTATION_STATE_FILE + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False)
-        os.replace(tmp, ROTATION_STATE_FILE)  # атомарная запись
+        return SqliteStateBackend(STATE_DB_FILE)
     except Exception as e:
-        logger.warning(f"Не удалось сохранить состояние ротации: {e}")
+        logger.warning(f"SQLite недоступен ({e}), используем JSON-состояние")
+        return JsonStateBackend()
+
+STATE = _make_state_backend()
+
+# индекс «уже было» живёт в памяти; бэкенд только дописывает изменения
+SEEN_LOCK = threading.Lock()
+_SEEN = None  # story_id -> ts, порядок вставки = порядок по времени
+_SEEN_VERSION = None  # STATE.seen_version() на момент загрузки / своей записи
+
+def _seen_index() -> dict:
+    """
+    Загружает индекс из STATE; перечитывает, если хранилище изменил другой
+    процесс (реплика, воркер). Вызывать под SEEN_LOCK.
+    """
+    global _SEEN, _SEEN_VERSION
+    version = STATE.seen_version()
+    if _SEEN is None or version != _SEEN_VERSION:
+        # единственная сортировка — при загрузке; дальше порядок держится вставкой
+        _SEEN = dict(sorted(STATE.load_seen().items(), key=lambda kv: kv[1]))
+        evicted = _prune_seen(_SEEN)
+        if evicted:
+            STATE.drop_seen(evicted)  # хранилище и индекс не расходятся
+        _SEEN_VERSION = version
+    return _SEEN
+
+def _prune_seen(seen: dict) -> list:
+    """Вытесняет с головы (самые старые): O(1) на удалённый элемент, без сортировки."""
+    cutoff = time.time() - SEEN_MAX_DAYS * 86400
+    evicted = []
+    while seen:
+        oldest = next(iter(seen))
+        if seen[oldest] >= cutoff and len(seen) <= SEEN_MAX_ITEMS:
+            break
+        del seen[oldest]
+        evicted.append(oldest)
+    return evicted
+
+def _mark_seen(story_id: str):
+    global _SEEN_VERSION
+    with SEEN_LOCK:
+        seen = _seen_index()
+        ts = time.time()
+        seen.pop(story_id, None)  # переставляем в хвост, чтобы порядок оставался по времени
+        seen[story_id] = ts
+        evicted = _prune_seen(seen)
+        STATE.add_seen(story_id, ts, seen, evicted)
+        _SEEN_VERSION = STATE.seen_version()  # своя запись — не повод перечитывать
 
-def _next_index(kind: str, total: int) -> int:
+def _is_seen(story_id: str) -> bool:
+    with SEEN_LOCK:
+        ts = _seen_index().get(story_id)
+    seen = ts is not None and ts >= time.time() - SEEN_MAX_DAYS * 86400
+    metric_inc("seen_lookups_total", result="hit" if seen else "miss")
+    return seen
+
+def _next_index(kind: str, total: int, avoid_key: str = None, names: list = None) -> int:
     """
     Возвращает ТЕКУЩИЙ индекс для kind ('rubric'|'news') и сразу
     продвигает его на +1 по кольцу. Потокобезопасно и переживает перезапуски.
+    С avoid_key/names — одной транзакцией пропускает элемент, совпавший
+    с сохранённым под avoid_key, и запоминает выбранный.
     """
-    with ROT_LOCK:
-        state = _load_rotation_state()
-        key = f"{kind}_index"
-        idx = int(state.get(key, 0))
-        state[key] = (idx + 1) % total
-        _save_rotation_state(state)
-        # держим глобалки в синхроне (если где-то читаются)
-        if kind == "rubric":
-            globals()["rubric_index"] = state[key]
-        elif kind == "news":
-            globals()["news_index"] = state[key]
-        return idx
+    idx = STATE.next_index(kind, total, avoid_key=avoid_key, names=names)
+    # держим глобалки в синхроне (если где-то читаются)
+    if kind == "rubric":
+        globals()["rubric_index"] = (idx + 1) % total
+    elif kind == "news":
+        globals()["news_index"] = (idx + 1) % total
+    return idx
+
+def _record_post(kind: str, text: str, caption_html: str, sent_as: str, topic: str = None):
+    STATE.record_post({
+        "ts": time.time(), "kind": kind, "topic": topic,
+        "title": _pick_title_line(text).strip(), "caption": caption_html, "sent_as": sent_as,
+    })
+
+# Рендер подписи: предкомпилированные шаблоны и один проход по строкам.
+# Повторяет прежний каскад re.sub байт-в-байт, включая его особенности: \s* в
+# шаблонах «перетекал» через пустые строки, поэтому пустые строки вокруг
+# подзаголовка и перед '— Подсчёт' поглощаются, а ':' может стоять строкой ниже.
+_COUNT_DASH_RE = re.compile(r"\s*[—\-–]\s*")
+_COUNT_WORD_RE = re.compile(r"Подсч[её]т:", re.IGNORECASE)
+_HEADING_RE = re.compile(r"\s*(Аналитика|Прогноз|Вывод|Шаги|Что делать инвестору)\s*(:?)\s*",
+                         re.IGNORECASE)
+_HEADINGS = {
+    "аналитика": "**📊 Аналитика:**",
+    "прогноз": "**📈 Прогноз:**",
+    "вывод": "**🧭 Вывод:**",
+    "шаги": "**🧩 Шаги:**",
+    "что делать инвестору": "**🧭 Что делать инвестору:**",
+}
+_COLON_LINE_RE = re.compile(r"\s*:\s*")
+_BOLD_LINE_RE = re.compile(r"\*\*.*\*\*")
+_BOLD_RE = re.compile(r"\*\*(.+?)\*\*", re.DOTALL)
+_TAG_RE = re.compile(r"<[^>]*>")
+
+def _tg_len(plain: str) -> int:
+    """Длина так, как её считает Telegram: в UTF-16 code units (эмодзи — 2)."""
+    return len(plain.encode("utf-16-le")) // 2
+
+def _tg_caption_len(caption_html: str) -> int:
+    """Длина готовой HTML-подписи глазами Telegram: без тегов, сущности — 1 символ."""
+    return _tg_len(html.unescape(_TAG_RE.sub("", caption_html or "")))
+
+def _next_filled(blank: list, i: int) -> int:
+    while i < len(blank) and blank[i]:
+        i += 1
+    return i
+
+def _drop_count_lines(lines: list, blank: list):
+    """'— Подсчёт: ...' (тире и слово могут быть на разных строках) вместе
+    с пустыми строками перед ним → одна пустая строка."""
+    out, out_blank, i, n = [], [], 0, len(lines)
+    while i < n:
+        a = _next_filled(blank, i)
+        m = _COUNT_DASH_RE.match(lines[a]) if a < n else None
+        b = None
+        if m:
+            rest = lines[a][m.end():]
+            if rest:
+                b = a if _COUNT_WORD_RE.match(rest) else None
+            else:
+                b = _next_filled(blank, a + 1)
+                if b == n or not _COUNT_WORD_RE.match(lines[b].lstrip()):
+                    b = None
+        if b is None:
+            out += lines[i:a + 1]
+            out_blank += blank[i:a + 1]
+            i = a + 1
+        else:
+            out.append("")
+            out_blank.append(True)
+            i = b + 1
+    return out, out_blank
+
+def _heading_lines(lines: list, blank: list) -> list:
+    """Подзаголовки → '**эмодзи Название:**'. Пустые строки до и после
+    поглощаются; одинаковые подзаголовки, разделённые только пустыми
+    строками, склеиваются в одну строку (как это делал re.sub)."""
+    out, i, n, glue = [], 0, len(lines), None
+    while i < n:
+        h = _next_filled(blank, i)
+        m = _HEADING_RE.fullmatch(lines[h]) if h < n else None
+        if not m:
+            out += lines[i:h + 1]
+            i, glue = h + 1, None
+            continue
+        key = m.group(1).lower()
+        if key == glue:
+            out[-1] += _HEADINGS[key]
+        else:
+            out.append(_HEADINGS[key])
+        colon, e = bool(m.group(2)), h + 1
+        while e < n:
+            if blank[e]:
+                e += 1
+            elif not colon and _COLON_LINE_RE.fullmatch(lines[e]):
+                colon, e = True, e + 1
+            else:
+                break
+        glue = key if e - 1 > h and not lines[e - 1] else None
+        i = e
+    return out
+
+def _space_bold_lines(lines: list) -> list:
+    """Пустая строка перед строкой '**...**', если предыдущая непуста. Как и
+    в re.sub, подряд идущие жирные строки (предыдущая кончается на '**') не
+    разделяются: её последний символ уже «съеден» прошлой заменой."""
+    out, eaten = [], False
+    for k, ln in enumerate(lines):
+        if k and lines[k - 1] and not eaten and _BOLD_LINE_RE.match(ln):
+            out.append("")
+            eaten = ln.endswith("**")
+        else:
+            eaten = False
+        out.append(ln)
+    return out
 
-def _polish_and_to_html(text: str) -> str:
+def _render_caption(text: str):
     """
+    Текст поста → (caption_html, длина подписи в Telegram):
     1) убирает '— Подсчёт: ...'
     2) нормализует подзаголовки (эмодзи + жирный)
     3) вставляет пустые строки перед подзаголовками
     4) конвертирует **...** → <b>...</b> и экранирует HTML
     """
     t = (text or "").strip()
-    # убрать строку '— Подсчёт: ...'
-    t = re.sub(r'(?im)^\s*[—\-–]\s*Подсч[её]т:.*$', '', t)
-
-    # заголовки
-    t = re.sub(r'(?im)^\s*Аналитика\s*:?\s*$', '**📊 Аналитика:**', t, flags=re.MULTILINE)
-    t = re.sub(r'(?im)^\s*Прогноз\s*:?\s*$',   '**📈 Прогноз:**',   t, flags=re.MULTILINE)
-    t = re.sub(r'(?im)^\s*Вывод\s*:?\s*$',     '**🧭 Вывод:**',     t, flags=re.MULTILINE)
-    t = re.sub(r'(?im)^\s*Шаги\s*:?\s*$',                 '**🧩 Шаги:**',                 t, flags=re.MULTILINE)
-    t = re.sub(r'(?im)^\s*Что делать инвестору\s*:?\s*$', '**🧭 Что делать инвестору:**', t, flags=re.MULTILINE)
+    lines = t.split("\n")
+    blank = [not ln.strip() for ln in lines]
+    if _COUNT_WORD_RE.search(t):
+        lines, blank = _drop_count_lines(lines, blank)
+    t = "\n".join(_space_bold_lines(_heading_lines(lines, blank)))
+
+    parts, plain, pos = [], [], 0
+    for m in _BOLD_RE.finditer(t):
+        gap, inner = t[pos:m.start()], m.group(1)
+        parts += [html.escape(gap), "<b>", html.escape(inner), "</b>"]
+        plain += [gap, inner]
+        pos = m.end()
+    parts.append(html.escape(t[pos:]))
+    plain.append(t[pos:])
+    # .strip() у HTML снимает только крайние пробелы вне тегов
+    plain[0] = plain[0].lstrip()
+    plain[-1] = plain[-1].rstrip()
+    return "".join(parts).strip(), _tg_len("".join(plain))
 
-    # пустая строка перед подзаголовками
-    t = re.sub(r'(?m)([^\n])\n(\*\*[^\n]*\*\*)', r'\1\n\n\2', t)
-    # и перенос после
-    t = re.sub(r'(?m)(\*\*[^\n]*\*\*)\n(?!\n)', r'\1\n', t)
-
-    # временно скрываем **...**
-    placeholders = []
-    def _keep_bold(m):
-        placeholders.append(m.group(1))
-        return f"@@B{len(placeholders)-1}@@"
-
-    t = re.sub(r"\*\*(.+?)\*\*", _keep_bold, t, flags=re.DOTALL)
-
-    # экранируем HTML
-    t = html.escape(t)
-
-    # возвращаем <b>...</b>
-    for i, content in enumerate(placeholders):
-        t = t.replace(f"@@B{i}@@", f"<b>{html.escape(content)}</b>")
-
-    return t.strip()
+def _polish_and_to_html(text: str) -> str:
+    """Совместимая обёртка: только HTML подписи."""
+    return _render_caption(text)[0]
 
-def _regenerate_to_fit(original_text: str, target_limits=(940, 900, 860)) -> str:
+def _regenerate_to_fit(original_text: str, target_limits=(940, 900, 860), budget=None) -> str:
     """
     Перегенерирует пост короче, чтобы уместиться в лимит подписи Telegram после HTML.
     Не добавляет «…», не обрезает — просит LLM написать компактнее.
+    По одному вызову на цель, в рамках budget.
     """
     base = (original_text or "").strip()
+    budget = budget or PostBudget(max_calls=len(target_limits))
     for tgt in target_limits:
+        if budget.exhausted():
+            break
         try:
-            prompt = (
-                "Перепиши этот пост КОРОЧЕ, сохранив структуру и смысл: "
-                "заголовок с эмодзи, подзаголовок-зацеп, краткое вступление, "
-                "жирные подзаголовки, аналитика/прогноз, вывод, вопрос в конце. "
-                "Без хештегов. Без искусственного многоточия в конце. "
-                f"СТРОГО: общий объём не более {tgt} символов в чистом тексте.\n\n"
-                f"Текст:\n{base}"
-            )
-            new_text = generate_post_text(prompt)
-            if not new_text:
-                continue
-            html_ver = _polish_and_to_html(new_text)
-            if len(html_ver) <= CAPTION_LIMIT:
+            new_text, reason = _complete(_shorten_prompt(base, tgt), SYSTEM_PROMPT, budget)
+            if reason is None and new_text and _render_caption(new_text)[1] <= CAPTION_LIMIT:
                 return new_text.strip()
+            budget.reject(reason or f"не уложились в {tgt}", new_text)
         except Exception:
             continue
     return base  # если не уложились после нескольких попыток — вернём исходник
 
+# Локальное ужатие подписи: без LLM, только целые единицы текста.
+_LIST_ITEM_RE = re.compile(r"\s*(?:\d{1,2}[.)]|[-•–—])\s+\S")
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+(?=[«\"(]?[A-ZА-ЯЁ0-9])")
+# точка после них — не конец предложения: «2025 г. Минфин», «4 трлн руб. сверх»;
+# инициалы и «т.е.»/«т.д.» ловит правило одной буквы перед точкой
+_ABBREVIATIONS = {"г", "гг", "руб", "млн", "млрд", "трлн", "тыс", "долл", "им", "ст", "др", "см"}
+_LAST_WORD_RE = re.compile(r"([^\s«\"(]+)\.$")
+
+def _split_sentences(text: str) -> list:
+    """Предложения абзаца; «Э. Набиуллина» и «2025 г. Минфин» не разрываются."""
+    sentences = []
+    for part in _SENTENCE_SPLIT_RE.split(text):
+        m = _LAST_WORD_RE.search(sentences[-1]) if sentences else None
+        word = m.group(1).lower() if m else ""
+        last = word.rsplit(".", 1)[-1]
+        if m and ((len(last) == 1 and last.isalpha()) or word in _ABBREVIATIONS):
+            sentences[-1] += " " + part
+        else:
+            sentences.append(part)
+    return sentences
+
+def _caption_fits(text: str) -> bool:
+    return _render_caption(text)[1] <= CAPTION_LIMIT
+
+def _compact_to_fit(text: str, fits=None):
+    """
+    Детерминированно ужимает пост до лимита подписи, зная его раскладку
+    (заголовок, зацеп, жирные подзаголовки, списки, вопрос в конце).
+    По приоритету: лишние пустые строки → последние пункты списков (минимум
+    2 остаются) → второстепенные предложения абзацев (без цифр — первыми,
+    с конца поста; первое предложение абзаца и финальный вопрос не трогаем)
+    → пустые строки между абзацами → целые второстепенные абзацы (раздел под
+    подзаголовком не остаётся пустым). Предложения не режутся посередине.
+    Возвращает ужатый текст или None, если так не уложиться.
+    """
+    fits = fits or _caption_fits
+    lines = (text or "").strip().split("\n")
+    if fits("\n".join(lines)):
+        return "\n".join(lines)
+
+    def _kind(ln: str) -> str:
+        s = ln.strip()
+        if not s:
+            return "blank"
+        if _HEADING_RE.fullmatch(ln) or (s.startswith("**") and s.endswith("**")) \
+                or (_COUNT_WORD_RE.search(s) and _COUNT_DASH_RE.match(s)):
+            return "heading"
+        if _LIST_ITEM_RE.match(ln):
+            return "item"
+        return "text"
+
+    # 1) подряд идущие пустые строки → одна
+    lines = [ln for k, ln in enumerate(lines) if ln.strip() or k == 0 or lines[k - 1].strip()]
+    if fits("\n".join(lines)):
+        return "\n".join(lines)
+
+    # 2) пункты списков: с конца самого длинного списка, пока в нём больше двух
+    while True:
+        kinds = [_kind(ln) for ln in lines]
+        runs, start = [], None
+        for k, kind in enumerate(kinds + ["end"]):
+            if kind == "item" and start is None:
+                start = k
+            elif kind != "item" and start is not None:
+                runs.append((start, k))
+                start = None
+        runs = [r for r in runs if r[1] - r[0] > 2]
+        if not runs:
+            break
+        start, stop = max(runs, key=lambda r: (r[1] - r[0], r[0]))
+        del lines[stop - 1]
+        if fits("\n".join(lines)):
+            return "\n".join(lines)
+
+    # 3) второстепенные предложения
+    kinds = [_kind(ln) for ln in lines]
+    filled = [k for k, kind in enumerate(kinds) if kind != "blank"]
+    protected = set(filled[:1])  # заголовок
+    if len(filled) > 1 and len(lines[filled[1]].strip()) <= 80:
+        protected.add(filled[1])  # зацеп
+    sentences = {k: _split_sentences(lines[k].strip()) for k in filled
+                 if kinds[k] == "text" and k not in protected}
+    candidates = []
+    for k, parts in sentences.items():
+        for j in range(1, len(parts)):
+            if k == filled[-1] and j == len(parts) - 1 and "?" in parts[j]:
+                continue  # вопрос подписчику
+            candidates.append((any(ch.isdigit() for ch in parts[j]), -k, -j, k, j))
+    for *_, k, j in sorted(candidates):
+        sentences[k][j] = None
+        lines[k] = " ".join(s for s in sentences[k] if s is not None)
+        if fits("\n".join(lines)):
+            return "\n".join(lines)
+
+    # 4) пустые строки между абзацами (перед подзаголовком рендер вставит их сам)
+    for k in range(len(lines) - 2, 0, -1):
+        if not lines[k].strip() and _kind(lines[k + 1]) != "heading":
+            del lines[k]
+            if fits("\n".join(lines)):
+                return "\n".join(lines)
+
+    # 5) целые абзацы — когда в них одно предложение и резать больше нечего
+    while True:
+        kinds = [_kind(ln) for ln in lines]
+        filled = [k for k, kind in enumerate(kinds) if kind != "blank"]
+        protected = set(filled[:1])
+        if len(filled) > 1 and len(lines[filled[1]].strip()) <= 80:
+            protected.add(filled[1])
+        if filled and "?" in lines[filled[-1]]:
+            protected.add(filled[-1])  # вопрос подписчику
+        candidates = []
+        for k in filled:
+            if kinds[k] != "text" or k in protected:
+                continue
+            # соседи по разделу (между подзаголовками): раздел не должен опустеть
+            lo = max([h for h in filled if h < k and kinds[h] == "heading"], default=-1)
+            hi = min([h for h in filled if h > k and kinds[h] == "heading"], default=len(lines))
+            if any(lo < m < hi and m != k and kinds[m] in ("text", "item") for m in filled):
+                candidates.append((any(ch.isdigit() for ch in lines[k]), -k, k))
+        if not candidates:
+            return None
+        k = min(candidates)[-1]
+        del lines[k]
+        if fits("\n".join(lines)):
+            return "\n".join(lines)
+
 # ─── Контентные настройки (оставлены как были) ────────────────────────────────
+# слоты публикаций (МСК): (час, минута, вид); пост истории — САМЫЙ ПЕРВЫЙ
+SCHEDULE = [
+    (8, 30, "history"),
+    (9, 26, "news"),
+    (11, 42, "rubric"),
+    (13, 24, "news"),
+    (16, 5, "rubric"),
+    (18, 47, "news"),
+    (19, 47, "rubric"),
+]
+
 rubrics = [
     "Финсовет дня", "Финликбез", "Личный финменеджмент", "Деньги в цифрах",
     "Кейс / Разбор", "Психология денег", "Финансовая ошибка", "Продукт недели",
@@ -387,23 +1578,332 @@ HISTORY_HINT = (
 )
 
 # ─── Генерация текста/картинок ────────────────────────────────────────────────
-def generate_post_text(user_prompt, system_prompt=None):
+# ➕ Новое: кэш ответов LLM (content-addressed), LRU в памяти + файлы на Volume
+LLM_CACHE_LOCK = threading.Lock()
+LLM_CACHE_STATS = {"mem_hits": 0, "disk_hits": 0, "misses": 0, "bypass": 0, "stores": 0}
+_LLM_MEM = OrderedDict()  # key -> (ts, content)
+_LLM_PUTS = 0
+
+def _llm_cache_key(model: str, system_prompt: str, user_prompt: str, temperature: float) -> str:
+    raw = json.dumps([model, system_prompt, user_prompt, temperature], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _llm_cache_path(key: str) -> str:
+    return os.path.join(LLM_CACHE_DIR, f"{key}.json")
+
+def _llm_cache_get(key: str):
+    cutoff = time.time() - LLM_CACHE_TTL_HOURS * 3600
+    with LLM_CACHE_LOCK:
+        hit = _LLM_MEM.get(key)
+        if hit and hit[0] >= cutoff:
+            _LLM_MEM.move_to_end(key)
+            LLM_CACHE_STATS["mem_hits"] += 1
+            return hit[1]
     try:
-        sys_prompt = system_prompt or SYSTEM_PROMPT
-        for _ in range(5):
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": sys_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.6,
-            )
-            content = response.choices[0].message.content.strip().replace("###", "")
-            if len(content) <= 1015:
-                return content
-        logger.warning("⚠️ GPT не смог уложиться в лимит. Возвращаем None.")
+        with open(_llm_cache_path(key), "r", encoding="utf-8") as f:
+            rec = json.load(f)
+        if rec.get("ts", 0) >= cutoff:
+            with LLM_CACHE_LOCK:
+                _llm_mem_put(key, rec["ts"], rec["content"])
+                LLM_CACHE_STATS["disk_hits"] += 1
+            return rec["content"]
+    except Exception:
+        pass
+    with LLM_CACHE_LOCK:
+        LLM_CACHE_STATS["misses"] += 1
+    return None
+
+def _llm_mem_put(key: str, ts: float, content: str):
+    """Вызывать под LLM_CACHE_LOCK."""
+    _LLM_MEM[key] = (ts, content)
+    _LLM_MEM.move_to_end(key)
+    while len(_LLM_MEM) > LLM_CACHE_MEM_ITEMS:
+        _LLM_MEM.popitem(last=False)
+
+def _llm_cache_put(key: str, model: str, content: str):
+    global _LLM_PUTS
+    ts = time.time()
+    with LLM_CACHE_LOCK:
+        _llm_mem_put(key, ts, content)
+        LLM_CACHE_STATS["stores"] += 1
+        _LLM_PUTS += 1
+        prune = _LLM_PUTS % 20 == 0
+    try:
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+        tmp = f"{_llm_cache_path(key)}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"ts": ts, "model": model, "content": content}, f, ensure_ascii=False)
+        os.replace(tmp, _llm_cache_path(key))  # атомарная запись
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить кэш LLM: {e}")
+    if prune:
+        _prune_llm_cache()
+
+def _prune_llm_cache():
+    """
+    Раз в 20 записей: удаляем просроченные файлы и самые старые сверх лимита.
+    Чистит один процесс за раз; файлы, которые успел удалить другой, пропускаем.
+    """
+    cutoff = time.time() - LLM_CACHE_TTL_HOURS * 3600
+    try:
+        with interprocess_lock("llm_cache"):
+            files = []
+            for name in os.listdir(LLM_CACHE_DIR):
+                p = os.path.join(LLM_CACHE_DIR, name)
+                try:
+                    mtime = os.stat(p).st_mtime
+                    if mtime < cutoff:
+                        os.remove(p)
+                    else:
+                        files.append((mtime, p))
+                except FileNotFoundError:
+                    continue
+            files.sort(reverse=True)
+            for _, p in files[LLM_CACHE_MAX_ITEMS:]:
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+    except Exception as e:
+        logger.warning(f"Не удалось почистить кэш LLM: {e}")
+
+# ➕ Новое: оркестратор генерации с явным бюджетом на пост
+# общие для всех потоков лимиты запросов к OpenAI: kind ("text" | "image") -> TokenBucket
+OPENAI_BUCKETS = {}
+
+def set_openai_rpm(kind: str, rpm: float):
+    OPENAI_BUCKETS[kind] = TokenBucket(rpm / 60.0, max(1.0, rpm / 60.0)) if rpm > 0 else None
+
+set_openai_rpm("text", OPENAI_RPM)
+set_openai_rpm("image", OPENAI_IMAGE_RPM)
+
+def _openai_throttle(kind: str):
+    bucket = OPENAI_BUCKETS.get(kind)
+    if bucket is not None:
+        bucket.acquire()
+
+class PostBudget:
+    """Лимиты на один пост: вызовы LLM, токены, секунды. Копит причины отказов."""
+
+    def __init__(self, max_calls=None, max_tokens=None, max_seconds=None):
+        self.max_calls = GEN_MAX_CALLS if max_calls is None else max_calls
+        self.max_tokens = GEN_MAX_TOKENS if max_tokens is None else max_tokens
+        self.max_seconds = GEN_MAX_SECONDS if max_seconds is None else max_seconds
+        self.started = time.monotonic()
+        self.calls = 0
+        self.tokens = 0
+        self.rejections = []  # [{"attempt", "reason", "chars", "html_chars", "at"}]
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def exhausted(self):
+        """Причина исчерпания бюджета или None."""
+        if self.calls >= self.max_calls:
+            return f"calls {self.calls}/{self.max_calls}"
+        if self.tokens >= self.max_tokens:
+            return f"tokens {self.tokens}/{self.max_tokens}"
+        if self.elapsed() >= self.max_seconds:
+            return f"time {self.elapsed():.0f}s/{self.max_seconds:.0f}s"
         return None
+
+    def add_tokens(self, n: int):
+        self.tokens += n
+        metric_inc("openai_tokens_total", n, model=TEXT_MODEL)
+
+    def reject(self, reason: str, text: str = "", html_text: str = None):
+        metric_inc("openai_retries_total")
+        self.rejections.append({
+            "attempt": self.calls, "reason": reason, "chars": len(text or ""),
+            "html_chars": len(html_text) if html_text is not None else None,
+            "at": round(self.elapsed(), 2),
+        })
+
+    def summary(self) -> str:
+        reasons = "; ".join(f"#{r['attempt']} {r['reason']}" for r in self.rejections) or "—"
+        return (f"calls={self.calls} tokens={self.tokens} time={self.elapsed():.1f}s "
+                f"rejected: {reasons}")
+
+def _shorten_prompt(text: str, target: int) -> str:
+    return (
+        "Перепиши этот пост КОРОЧЕ, сохранив структуру и смысл: "
+        "заголовок с эмодзи, подзаголовок-зацеп, краткое вступление, "
+        "жирные подзаголовки, аналитика/прогноз, вывод, вопрос в конце. "
+        "Без хештегов. Без искусственного многоточия в конце. "
+        f"СТРОГО: общий объём не более {target} символов в чистом тексте.\n\n"
+        f"Текст:\n{text}"
+    )
+
+def _stream_completion(messages: list, budget: PostBudget):
+    """
+    Стриминговая генерация: текст копится по мере прихода, и как только проекция
+    длины подписи (как её считает Telegram) уверенно превышает CAPTION_LIMIT (или текст —
+    PLAIN_TEXT_LIMIT) больше, чем сможет снять _compact_to_fit, стрим закрывается.
+    Возвращает (text, reason).
+    """
+    _openai_throttle("text")
+    stream = _stage_client().chat.completions.create(
+        model=TEXT_MODEL,
+        messages=messages,
+        temperature=TEXT_TEMPERATURE,
+        max_tokens=GEN_MAX_OUTPUT_TOKENS,
+        timeout=max(5.0, budget.max_seconds - budget.elapsed()),
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    parts, size, checked, chunks, finish = [], 0, 0, 0, None
+    try:
+        for chunk in stream:
+            # timeout клиента — на каждое чтение; медленный стрим режем по общему бюджету
+            if budget.elapsed() > budget.max_seconds:
+                budget.add_tokens(chunks + sum(len(m["content"]) for m in messages) // 3)
+                return "".join(parts).strip().replace("###", ""), \
+                    f"стрим прерван: вышло время {budget.max_seconds:.0f}s"
+            if chunk.usage:
+                budget.add_tokens(chunk.usage.total_tokens)
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            delta = choice.delta.content or ""
+            finish = choice.finish_reason or finish
+            if not delta:
+                continue
+            parts.append(delta)
+            size += len(delta)
+            chunks += 1
+            # полировка — не на каждый токен, а раз в GEN_STREAM_CHECK_EVERY символов
+            if size - checked < GEN_STREAM_CHECK_EVERY:
+                continue
+            checked = size
+            text = "".join(parts).replace("###", "")
+            if len(text.strip()) > PLAIN_TEXT_LIMIT + GEN_STREAM_SLACK + GEN_COMPACT_MAX:
+                reason = f"стрим прерван: текст ≥{len(text.strip())} > {PLAIN_TEXT_LIMIT}"
+            elif _render_caption(text)[1] > CAPTION_LIMIT + GEN_STREAM_SLACK + GEN_COMPACT_MAX:
+                reason = f"стрим прерван: подпись > {CAPTION_LIMIT} на {size} символах"
+            else:
+                continue
+            # usage в оборванном стриме не приходит — оцениваем: ~1 токен на чанк
+            # плюс промпт (~3 символа на токен)
+            budget.add_tokens(chunks + sum(len(m["content"]) for m in messages) // 3)
+            return text.strip(), reason
+    finally:
+        stream.close()
+    text = "".join(parts).strip().replace("###", "")
+    if finish == "length":
+        return text, f"обрезан по max_tokens={GEN_MAX_OUTPUT_TOKENS}"
+    return text, None
+
+def _complete(user_prompt: str, sys_prompt: str, budget: PostBudget, fresh=False):
+    """
+    Один вызов LLM в рамках бюджета (или ответ из кэша — бесплатно).
+    Возвращает (text, reason): при отказе reason — почему (text может быть неполным).
+    """
+    key = _llm_cache_key(TEXT_MODEL, sys_prompt, user_prompt, TEXT_TEMPERATURE)
+    if LLM_CACHE_ENABLED and not fresh:
+        cached = _llm_cache_get(key)
+        if cached is not None:
+            logger.info("💾 Текст взят из кэша LLM")
+            return cached, None
+    elif LLM_CACHE_ENABLED:
+        with LLM_CACHE_LOCK:
+            LLM_CACHE_STATS["bypass"] += 1
+    budget.calls += 1
+    messages = [
+        {"role": "system", "content": sys_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    with trace_span("llm", attempt=budget.calls, stream=GEN_STREAM) as span:
+        if GEN_STREAM:
+            with metric_timer("openai_request_seconds", kind="text_stream"):
+                text, reason = _stream_completion(messages, budget)
+        else:
+            with metric_timer("openai_request_seconds", kind="text"):
+                text, reason = _plain_completion(messages, budget)
+        span.update(outcome=reason or "ok", chars=len(text))
+    return text, reason
+
+def _plain_completion(messages: list, budget: PostBudget):
+    """Обычный (не стриминговый) вызов. Возвращает (text, reason)."""
+    _openai_throttle("text")
+    response = _stage_client().chat.completions.create(
+        model=TEXT_MODEL,
+        messages=messages,
+        temperature=TEXT_TEMPERATURE,
+        max_tokens=GEN_MAX_OUTPUT_TOKENS,
+        timeout=max(5.0, budget.max_seconds - budget.elapsed()),
+    )
+    if response.usage:
+        budget.add_tokens(response.usage.total_tokens)
+    choice = response.choices[0]
+    content = (choice.message.content or "").strip().replace("###", "")
+    if choice.finish_reason == "length":
+        return content, f"обрезан по max_tokens={GEN_MAX_OUTPUT_TOKENS}"
+    return content, None
+
+def _accept(text: str):
+    """Финальная проверка кандидата. Возвращает (caption_html, reason)."""
+    if not text:
+        return None, "пустой ответ"
+    if len(text) > PLAIN_TEXT_LIMIT:
+        return None, f"текст {len(text)} > {PLAIN_TEXT_LIMIT}"
+    caption_html, tg_len = _render_caption(text)
+    if tg_len > CAPTION_LIMIT:
+        return None, f"подпись {tg_len} > {CAPTION_LIMIT}"
+    return caption_html, None
+
+def generate_post(user_prompt, system_prompt=None, fresh=False, budget=None):
+    """
+    Единая генерация поста в рамках PostBudget: первый кандидат, прошедший
+    финальную проверку длины подписи, сразу возвращается. Слишком длинный кандидат
+    не перебрасывается, а ужимается: сначала локально (_compact_to_fit), затем
+    через LLM (каскад SHORTEN_TARGETS); пустой/ошибочный —
+    перегенерируется. Возвращает (text, caption_html, budget); при неудаче text=None.
+    """
+    sys_prompt = system_prompt or SYSTEM_PROMPT
+    budget = budget or PostBudget(max_seconds=_stage_remaining(GEN_MAX_SECONDS))
+    prompt, targets, use_cache = user_prompt, list(SHORTEN_TARGETS), not fresh
+    while budget.exhausted() is None:
+        try:
+            text, reason = _complete(prompt, sys_prompt, budget, fresh=not use_cache)
+        except Exception as e:
+            budget.reject(f"ошибка API: {e}")
+            continue
+        if reason is not None:
+            # оборванный черновик ужимать бессмысленно — заново, с просьбой писать короче
+            budget.reject(reason, text)
+            prompt, use_cache = user_prompt + TOO_LONG_HINT, False
+            continue
+        with trace_span("accept", attempt=budget.calls) as span:
+            html_text, reason = _accept(text)
+            if reason is not None and text:
+                compact = _compact_to_fit(text, fits=lambda t: _accept(t)[1] is None)
+                if compact is not None:
+                    # перелёт небольшой — ужимаем локально, без ещё одного вызова LLM
+                    logger.info("✂️ Текст ужат локально: %d → %d символов", len(text), len(compact))
+                    text = compact
+                    html_text, reason = _accept(text)
+                    span["compacted"] = True
+            span["outcome"] = reason or "ok"
+        if reason is None:
+            if LLM_CACHE_ENABLED:
+                # кэшируем итог под исходным промптом, даже если он получен ужатием
+                _llm_cache_put(_llm_cache_key(TEXT_MODEL, sys_prompt, user_prompt, TEXT_TEMPERATURE),
+                               TEXT_MODEL, text)
+            logger.info("✍️ Текст готов: %s", budget.summary())
+            return text, html_text, budget
+        budget.reject(reason, text, html_text)
+        use_cache = False  # повтор того же промпта не должен вернуть тот же ответ
+        if text and targets:
+            prompt = _shorten_prompt(text, targets.pop(0))
+        else:
+            prompt = user_prompt
+    logger.warning("⚠️ Бюджет генерации исчерпан (%s): %s", budget.exhausted(), budget.summary())
+    return None, None, budget
+
+def generate_post_text(user_prompt, system_prompt=None, fresh=False):
+    """Совместимая обёртка: только текст (или None)."""
+    try:
+        return generate_post(user_prompt, system_prompt=system_prompt, fresh=fresh)[0]
     except Exception as e:
         logger.error(f"Ошибка генерации текста: {e}")
         return None
@@ -432,48 +1932,156 @@ def generate_image(title_line, style="news"):
 
         prompt = base_prompt + "\n" + style_hint + "\n" + NEGATIVE_SUFFIX
 
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            size="1024x1024",
-            quality="hd",
-            n=1
-        )
+        _openai_throttle("image")
+        with trace_span("dalle"), metric_timer("openai_request_seconds", kind="image"):
+            response = _stage_client().images.generate(
+                model="dall-e-3",
+                prompt=prompt,
+                size="1024x1024",
+                quality="hd",
+                n=1,
+                timeout=_stage_remaining(JOB_STAGE_DEADLINES["image"]),
+            )
         return response.data[0].url
 
     except Exception as e:
         logger.error(f"Ошибка генерации изображения: {e}")
         return None
 
-def publish_post(content, image_url):
+class _SendAsFile(Exception):
+    """Внутренний сигнал publish_post: пропустить отправку по URL."""
+
+TG_GLOBAL_BUCKET = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+TG_CHAT_BUCKETS_LOCK = threading.Lock()
+_TG_CHAT_BUCKETS = {}  # chat_id -> TokenBucket
+
+def _chat_bucket(chat_id) -> TokenBucket:
+    with TG_CHAT_BUCKETS_LOCK:
+        bucket = _TG_CHAT_BUCKETS.get(str(chat_id))
+        if bucket is None:
+            bucket = _TG_CHAT_BUCKETS[str(chat_id)] = TokenBucket(TG_CHAT_RATE_PER_MIN / 60.0, TG_CHAT_BURST)
+        return bucket
+
+def _tg_send_photo(chat_id, photo, caption_html: str, via: str):
+    """send_photo с учётом лимитов Bot API (чат + бот целиком).
+       На RetryAfter ставим чат на паузу, сколько просит Telegram, и повторяем."""
+    for attempt in range(1, TG_RETRY_AFTER_MAX + 2):
+        # очередь (в т.ч. пауза после RetryAfter) ограничена только дедлайном стадии
+        wait_s = _stage_remaining(float("inf"))
+        bucket = _chat_bucket(chat_id)
+        if not bucket.acquire(wait_s):
+            raise TimeoutError(f"очередь отправки в {chat_id} не подошла до дедлайна стадии")
+        if not TG_GLOBAL_BUCKET.acquire(wait_s):
+            bucket.refund()  # токен чата не потрачен — вернём
+            raise TimeoutError("общая очередь отправки не подошла до дедлайна стадии")
+        timeout = _stage_remaining(20.0)
+        try:
+            with trace_span("telegram", via=via, chat=str(chat_id), attempt=attempt), \
+                    metric_timer("telegram_send_seconds", via=via):
+                return bot.send_photo(
+                    chat_id=chat_id,
+                    photo=photo,
+                    caption=caption_html,
+                    parse_mode=telegram.ParseMode.HTML,
+                    timeout=timeout,
+                )
+        except telegram_error.RetryAfter as e:
+            metric_inc("telegram_retry_after_total")
+            if attempt > TG_RETRY_AFTER_MAX:
+                raise
+            logger.warning("⏳ Telegram просит подождать %s с (%s, попытка %d)", e.retry_after, chat_id, attempt)
+            bucket.pause(float(e.retry_after))
+
+def _fan_out(channels: list, photo_id, image_url, image_bytes, caption_html: str) -> int:
+    """
+    Рассылает уже опубликованный пост по зеркалам параллельно. Фото — по file_id
+    из первой отправки (без повторной загрузки); если его нет — тем же способом,
+    что сработал в основном канале. Ошибка в одном зеркале не мешает остальным.
+    Возвращает число успешных отправок.
+    """
+    job = getattr(_JOB_CTX, "job", None)
+
+    def send(chat_id):
+        _JOB_CTX.job = job  # стадия и спаны — в задачу, из которой публикуем
+        try:
+            if photo_id:
+                photo, via = photo_id, "file_id"
+            elif image_bytes is not None:
+                photo, via = telegram.InputFile(BytesIO(image_bytes), filename="cover.png"), "file"
+            else:
+                photo, via = image_url, "url"
+            _tg_send_photo(chat_id, photo, caption_html, via=via)
+            metric_inc("mirror_total", via=via)
+            return True
+        except Exception as e:
+            metric_inc("mirror_total", via="failed")
+            logger.error(f"Ошибка публикации в {chat_id}: {e}")
+            return False
+        finally:
+            _JOB_CTX.job = None
+
+    sent = sum(f.result() for f in [FANOUT_POOL.submit(send, chat_id) for chat_id in channels])
+    logger.info("📡 Зеркала: %d/%d", sent, len(channels))
+    return sent
+
+def _download_image(image_url: str) -> bytes:
+    timeout = _stage_remaining(30.0)
+    with trace_span("download_image") as span:
+        resp, body = http_get(image_url, timeout=timeout, max_bytes=HTTP_MAX_IMAGE_BYTES,
+                              deadline=time.monotonic() + timeout)
+        resp.raise_for_status()
+        span["bytes"] = len(body)
+    return body
+
+def publish_post(content, image_url, kind="post", topic=None, caption_html=None, image_bytes=None,
+                 channels=None):
     """Сначала пытаемся отправить по URL, при неудаче — скачиваем и шлём как файл.
-       Текст отправляем как HTML. Если превышен лимит Telegram — ПЕРЕГЕНЕРИРУЕМ, а не обрезаем."""
+       Текст отправляем как HTML. Если превышен лимит Telegram — ПЕРЕГЕНЕРИРУЕМ, а не обрезаем.
+       Успешная публикация попадает в историю постов (kind/topic — для неё).
+       caption_html — уже проверенная подпись из generate_post (пересборка не нужна);
+       image_bytes — заранее скачанная картинка черновика (сразу шлём файлом).
+       channels — куда публиковать (по умолчанию CHANNEL_ID + MIRROR_CHANNELS): в первый
+       канал фото загружается, в остальные уходит по file_id.
+       Возвращает True, если пост ушёл в первый канал."""
+    channels = channels or [CHANNEL_ID] + MIRROR_CHANNELS
     try:
         plain = (content or "").strip()
 
         # 1) первичная сборка HTML
-        caption_html = _polish_and_to_html(plain)
-
-        # 2) если выходим за лимит — просим модель написать компактнее и пересобираем
-        if len(caption_html) > CAPTION_LIMIT:
-            compact_plain = _regenerate_to_fit(plain)
+        if caption_html is None:
+            caption_html = _polish_and_to_html(plain)
+
+        # 2) если выходим за лимит — сначала ужимаем локально (без LLM)
+        if _tg_caption_len(caption_html) > CAPTION_LIMIT:
+            compact_plain = _compact_to_fit(plain)
+            if compact_plain is not None:
+                logger.info("✂️ Подпись ужата локально: %d → %d символов",
+                            len(plain), len(compact_plain))
+                plain, caption_html = compact_plain, _polish_and_to_html(compact_plain)
+
+        # 3) не вышло — просим модель написать компактнее и пересобираем
+        if _tg_caption_len(caption_html) > CAPTION_LIMIT:
+            budget = PostBudget(max_calls=GEN_FIT_MAX_CALLS)
+            compact_plain = _regenerate_to_fit(plain, budget=budget)
             caption_html = _polish_and_to_html(compact_plain)
             # дополнительная страховка: если вдруг всё ещё длинно — ещё одна попытка
-            if len(caption_html) > CAPTION_LIMIT:
-                compact_plain = _regenerate_to_fit(compact_plain, target_limits=(880, 840, 800))
+            if _tg_caption_len(caption_html) > CAPTION_LIMIT:
+                compact_plain = _regenerate_to_fit(compact_plain, target_limits=(880, 840, 800),
+                                                   budget=budget)
                 caption_html = _polish_and_to_html(compact_plain)
+            plain = compact_plain
 
-        # Попытка 1: URL
+        # Попытка 1: URL (если картинки ещё нет на руках)
+        message, sent_as = None, None
         try:
-            bot.send_photo(
-                chat_id=CHANNEL_ID,
-                photo=image_url,
-                caption=caption_html,
-                parse_mode=telegram.ParseMode.HTML
-            )
+            if image_bytes is not None:
+                raise _SendAsFile()
+            message = _tg_send_photo(channels[0], image_url, caption_html, via="url")
+            sent_as = "url"
             logger.info("✅ Пост опубликован по URL")
-            return
-        except BadRequest as e:
+        except _SendAsFile:
+            pass
+        except telegram_error.BadRequest as e:
             msg = str(e)
             if ("Failed to get http url content" in msg
                 or "wrong type of the web page content" in msg
@@ -483,21 +2091,27 @@ def publish_post(content, image_url):
                 raise
 
         # Попытка 2: файл
-        with httpx.Client(timeout=30.0, follow_redirects=True) as c:
-            resp = c.get(image_url, headers={"User-Agent": "Mozilla/5.0"})
-            resp.raise_for_status()
-            image_bytes = resp.content
-
-        file_obj = telegram.InputFile(BytesIO(image_bytes), filename="cover.png")
-        bot.send_photo(
-            chat_id=CHANNEL_ID,
-            photo=file_obj,
-            caption=caption_html,
-            parse_mode=telegram.ParseMode.HTML
-        )
-        logger.info("✅ Пост опубликован (отправлено как файл)")
+        if sent_as is None:
+            if image_bytes is None:
+                image_bytes = _download_image(image_url)
+            file_obj = telegram.InputFile(BytesIO(image_bytes), filename="cover.png")
+            message = _tg_send_photo(channels[0], file_obj, caption_html, via="file")
+            sent_as = "file"
+            logger.info("✅ Пост опубликован (отправлено как файл)")
+
+        metric_inc("publish_total", via=sent_as)
+        _record_post(kind, plain, caption_html, sent_as, topic=topic)
     except Exception as e:
+        metric_inc("publish_total", via="failed")
         logger.error(f"Ошибка публикации: {e}")
+        return False
+
+    if len(channels) > 1:
+        # самый большой размер из ответа — тот же файл, Telegram его уже хранит
+        photo_id = message.photo[-1].file_id if message is not None and message.photo else None
+        _fan_out(channels[1:], photo_id, image_url, image_bytes if sent_as == "file" else None,
+                 caption_html)
+    return True
 
 # ─── Ротация постов ───────────────────────────────────────────────────────────
 rubric_index = 0
@@ -511,19 +2125,13 @@ def _pick_title_line(text: str) -> str:
         (text or "").split('\n')[0]
     )
 
-def scheduled_rubric_post():
-    # индексы устойчивы к перезапуску
-    idx = _next_index("rubric", len(rubrics))
-    rubric = rubrics[idx]
-
-    # страховка от двух одинаковых рубрик подряд
-    state = _load_rotation_state()
-    last = state.get("last_rubric")
-    if last == rubric:
-        idx = _next_index("rubric", len(rubrics))
+def render_rubric_post(rubric=None):
+    """Готовит рубричный пост (текст, подпись, картинка) без публикации."""
+    if rubric is None:
+        # индексы устойчивы к перезапуску; страховка от двух одинаковых рубрик
+        # подряд (last_rubric) — в той же транзакции
+        idx = _next_index("rubric", len(rubrics), avoid_key="last_rubric", names=rubrics)
         rubric = rubrics[idx]
-    state["last_rubric"] = rubric
-    _save_rotation_state(state)
 
     logger.info(f"⏳ Генерация рубричного поста: {rubric}")
 
@@ -532,20 +2140,24 @@ def scheduled_rubric_post():
     f"{CONCRETE_HINT_RUBRIC}"
 )
 
-    attempts, text = 0, None
-    while attempts < 5:
-        text = generate_post_text(user_prompt, system_prompt=SYSTEM_PROMPT)
-        if text and len(text) <= 1015:
-            break
-        attempts += 1
-    else:
+    # промпт рубрики повторяется из цикла в цикл — нужен свежий текст
+    with job_stage("generate"):
+        text, caption_html, _ = generate_post(user_prompt, system_prompt=SYSTEM_PROMPT, fresh=True)
+    if not text:
         logger.warning("⚠️ GPT не смог уложиться в лимит. Возвращаем None.")
-        return
+        return None
 
     title_line = _pick_title_line(text)
-    image_url = generate_image(title_line, style="news")
-    if image_url:
-        publish_post(text, image_url)
+    with job_stage("image"):
+        image_url = generate_image(title_line, style="news")
+    if not image_url:
+        return None
+    return {"kind": "rubric", "topic": rubric, "text": text,
+            "caption_html": caption_html, "image_url": image_url}
+
+def scheduled_rubric_post():
+    draft = _take_draft("rubric") or render_rubric_post(rubric=_pop_planned_topic("rubric"))
+    return _publish_draft(draft) if draft else None
 
 # ── NEW: «В этот день в финансах» ─────────────────────────────────────────────
 _FIN_KW_RU = [
@@ -562,75 +2174,180 @@ _FIN_KW_EN = [
     "great depression", "oil crisis", "dot-com", "credit"
 ]
 
+# сильные маркеры
+_FIN_KW_STRONG = ["кризис", "default", "panic", "бреттон", "bretton", "gold standard", "great depression", "bankruptcy"]
+
+# словари по рубрикам/темам: имя → KeywordScorer; дополняются из KEYWORD_VOCAB_FILE
+KEYWORD_SCORERS = {
+    "fin_event": KeywordScorer.from_lists((2, _FIN_KW_RU), (2, _FIN_KW_EN), (4, _FIN_KW_STRONG)),
+}
+
+def _load_keyword_vocabs():
+    """JSON {"имя": {"термин": вес, …}, …} — добавляет/переопределяет словари."""
+    if not KEYWORD_VOCAB_FILE or not os.path.exists(KEYWORD_VOCAB_FILE):
+        return
+    try:
+        with open(KEYWORD_VOCAB_FILE, "r", encoding="utf-8") as f:
+            for name, weights in json.load(f).items():
+                KEYWORD_SCORERS[name] = KeywordScorer(weights)
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить словари ключевых слов: {e}")
+
+_load_keyword_vocabs()
+
 def _score_fin_event(txt: str) -> int:
-    t = (txt or "").lower()
-    score = 0
-    for w in _FIN_KW_RU:
-        if w in t: score += 2
-    for w in _FIN_KW_EN:
-        if w in t: score += 2
-    # сильные маркеры
-    for w in ["кризис", "default", "panic", "бреттон", "bretton", "gold standard", "great depression", "bankruptcy"]:
-        if w in t: score += 4
-    return score
-
-def fetch_finance_event_today():
-    """Берём событие этого дня из Wikipedia (ru → en fallback), фильтруем по финансам."""
-    now = datetime.now(pytz.timezone("Europe/Moscow"))
-    m, d = now.month, now.day
-    urls = [
-        f"https://ru.wikipedia.org/api/rest_v1/feed/onthisday/events/{m}/{d}",
-        f"https://en.wikipedia.org/api/rest_v1/feed/onthisday/events/{m}/{d}",
-    ]
-    headers = {"User-Agent": "MinFinToolsBot/1.0 (+telegram)"}
+    return KEYWORD_SCORERS["fin_event"].score(txt)
 
+def _parse_onthisday(data: dict, lang: str) -> list:
+    """События одного ответа onthisday → финансовые кандидаты со score."""
     candidates = []
-    for url in urls:
+    events = data.get("events", [])
+    blobs = []
+    for ev in events:
+        pages = ev.get("pages") or []
+        blobs.append(" ".join([str(ev.get("year") or ""),
+                               (pages[0].get("normalizedtitle") if pages else "") or "",
+                               ev.get("text", "") or "",
+                               (pages[0].get("extract") if pages else "") or ""]))
+    scored = KEYWORD_SCORERS["fin_event"].score_many(blobs)
+    for ev, (score, terms) in zip(events, scored):
+        year = ev.get("year")
+        text = ev.get("text", "")  # краткое описание
+        pages = ev.get("pages") or []
+        title = pages[0].get("normalizedtitle") if pages else ""
+        extract = pages[0].get("extract") if pages else ""
+        link = ""
         try:
-            r = httpx.get(url, headers=headers, timeout=15)
-            r.raise_for_status()
-            data = r.json()
-            for ev in data.get("events", []):
-                year = ev.get("year")
-                text = ev.get("text", "")  # краткое описание
-                pages = ev.get("pages") or []
-                title = pages[0].get("normalizedtitle") if pages else ""
-                extract = pages[0].get("extract") if pages else ""
-                link = ""
-                try:
-                    link = pages[0]["content_urls"]["desktop"]["page"]
-                except Exception:
-                    pass
+            link = pages[0]["content_urls"]["desktop"]["page"]
+        except Exception:
+            pass
 
-                blob = " ".join([str(year or ""), title or "", text or "", extract or ""])
-                score = _score_fin_event(blob)
-                if score > 0:  # считаем финансовым
-                    candidates.append({
-                        "year": year,
-                        "title": title or text[:120],
-                        "summary": text or extract or "",
-                        "link": link,
-                        "lang": "ru" if "ru.wikipedia.org" in url else "en",
-                        "score": score
-                    })
-        except Exception as ex:
-            logger.warning("OnThisDay fetch fail %s: %s", url, ex)
+        if score > 0:  # считаем финансовым
+            candidates.append({
+                "year": year,
+                "title": title or text[:120],
+                "summary": text or extract or "",
+                "link": link,
+                "lang": lang,
+                "score": score,
+                "matched": terms,
+            })
+    return candidates
+
+def _fetch_onthisday_lang(lang: str, m: int, d: int, timeout: float = 15.0):
+    url = ONTHISDAY_URL.format(lang=lang, m=m, d=d)
+    headers = {"User-Agent": "MinFinToolsBot/1.0 (+telegram)"}
+    try:
+        r, body = http_get(url, headers=headers, timeout=timeout,
+                           deadline=time.monotonic() + timeout)
+        r.raise_for_status()
+        return _parse_onthisday(json.loads(body), lang)
+    except Exception as ex:
+        logger.warning("OnThisDay fetch fail %s: %s", url, ex)
+        return None
+
+def _fetch_onthisday(m: int, d: int):
+    """ru и en параллельно → кандидаты (ru первыми), отсортированные по score/году.
+    None — если не ответил ни один язык (чтобы не затирать индекс пустотой)."""
+    # потоки RSS_POOL не видят задачу — остаток дедлайна стадии считаем здесь
+    timeout = _stage_remaining(15.0)
+    futures = [RSS_POOL.submit(_fetch_onthisday_lang, lang, m, d, timeout) for lang in ("ru", "en")]
+    results = [f.result() for f in futures]
+    if all(r is None for r in results):
+        return None
+    candidates = [c for r in results if r for c in r]
+    # sorted стабилен: при равенстве ru остаётся впереди, как при прежнем обходе
+    return sorted(candidates, key=lambda x: (x["score"], x["year"] or 0), reverse=True)
+
+# ➕ Новое: локальный индекс «В этот день» по (месяц, день) + использованные годы
+ONTHISDAY_LOCK = threading.Lock()
+# {"days": {"MM-DD": {"fetched_at", "candidates"}}, "used": {"MM-DD": [год, …]}}
+_ONTHISDAY = SharedJsonStore(ONTHISDAY_FILE, "onthisday", "индекс «В этот день»")
+
+def _onthisday_index() -> dict:
+    """Индекс с диска (перечитывается, если его обновил другой процесс). Вызывать под ONTHISDAY_LOCK."""
+    data = _ONTHISDAY.data()
+    data.setdefault("days", {})
+    data.setdefault("used", {})
+    return data
+
+def _day_key(day) -> str:
+    return f"{day.month:02d}-{day.day:02d}"
+
+def _refresh_onthisday_day(day) -> bool:
+    candidates = _fetch_onthisday(day.month, day.day)
+    if candidates is None:
+        return False
+    def put(index):
+        index.setdefault("days", {})[_day_key(day)] = {"fetched_at": time.time(),
+                                                       "candidates": candidates}
+    with ONTHISDAY_LOCK:
+        _ONTHISDAY.update(put)
+    return True
+
+def prefetch_onthisday():
+    """Фоновая подкачка событий на сегодня и ONTHISDAY_PREFETCH_DAYS вперёд (TTL — ONTHISDAY_TTL_DAYS)."""
+    today = datetime.now(pytz.timezone("Europe/Moscow"))
+    cutoff = time.time() - ONTHISDAY_TTL_DAYS * 86400
+    for offset in range(ONTHISDAY_PREFETCH_DAYS + 1):
+        day = today + timedelta(days=offset)
+        with ONTHISDAY_LOCK:
+            rec = _onthisday_index()["days"].get(_day_key(day))
+        if rec and rec.get("fetched_at", 0) >= cutoff:
+            continue
+        if _refresh_onthisday_day(day):
+            with ONTHISDAY_LOCK:
+                rec = _onthisday_index()["days"].get(_day_key(day)) or {}
+                count = len(rec.get("candidates") or [])
+            logger.info("📚 OnThisDay %s: событий в индексе — %d", _day_key(day), count)
+
+def _mark_event_used(day_key: str, year):
+    if year is None:
+        return
+    def add(index):
+        # годы, отмеченные другими процессами, уже в свежей копии — дописываем свой
+        used = index.setdefault("used", {}).setdefault(day_key, [])
+        if year not in used:
+            used.append(year)
+    with ONTHISDAY_LOCK:
+        _ONTHISDAY.update(add)
+
+def fetch_finance_event_today(day=None):
+    """
+    Событие этого дня (или day) из локального индекса: самый «финансовый» год,
+    который ещё не публиковался в прошлые годы. Сеть — только если индекс
+    на этот день пуст (холодный старт).
+    """
+    now = day or datetime.now(pytz.timezone("Europe/Moscow"))
+    key = _day_key(now)
+    with ONTHISDAY_LOCK:
+        rec = _onthisday_index()["days"].get(key)
+    if not rec:
+        _refresh_onthisday_day(now)
+    with ONTHISDAY_LOCK:
+        index = _onthisday_index()
+        candidates = (index["days"].get(key) or {}).get("candidates") or []
+        used = set(index["used"].get(key, []))
 
     if not candidates:
         return None
 
-    # берём самый «финансовый»
-    pick = sorted(candidates, key=lambda x: (x["score"], x["year"] or 0), reverse=True)[0]
+    # берём самый «финансовый» из ещё не использованных; если всё было — лучший вообще
+    fresh = [c for c in candidates if c.get("year") not in used]
+    pick = dict((fresh or candidates)[0])
+    pick["day"] = key
     return pick
 
-def scheduled_history_post():
-    """Пост «В этот день в финансах» — 08:30 ежедневно."""
-    evt = fetch_finance_event_today()
+def render_history_post(day=None):
+    """Готовит пост «В этот день в финансах» на дату day (по умолчанию — сегодня)."""
+    day = day or datetime.now(pytz.timezone("Europe/Moscow"))
+    with job_stage("fetch"):
+        evt = fetch_finance_event_today(day)
     if not evt:
         logger.info("⏭️ Историческое событие не найдено — пропуск.")
-        return
+        return None
 
-    today = datetime.now(pytz.timezone("Europe/Moscow")).strftime("%-d %B %Y")
+    today = day.strftime("%-d %B %Y")
     facts = f"{evt.get('year','?')}: {evt.get('title','')} — {evt.get('summary','')}"
     # страхуем длину фактов, чтобы не раздувать prompt
     facts = facts.strip()
@@ -644,62 +2361,530 @@ def scheduled_history_post():
         f"{HISTORY_HINT}"
     )
 
-    text = generate_post_text(user_prompt)
+    with job_stage("generate"):
+        text, caption_html, _ = generate_post(user_prompt)
     if not text:
-        return
+        return None
     title_line = _pick_title_line(text)
     # для исторической рубрики используем чуть «светлее» оформление
-    image_url = generate_image(title_line, style="rubric")
-    if image_url:
-        publish_post(text, image_url)
+    with job_stage("image"):
+        image_url = generate_image(title_line, style="rubric")
+    if not image_url:
+        return None
+    return {"kind": "history", "topic": str(evt.get("year") or ""), "text": text,
+            "caption_html": caption_html, "image_url": image_url,
+            "event": {"day": evt["day"], "year": evt.get("year")}}
 
-# ─── Новости (как было) ───────────────────────────────────────────────────────
-def fetch_buzzy_rss_news(topic, per_feed=5, lookback_hours=48):
-    feeds = rss_sources.get(topic, [])
-    entries = []
+def scheduled_history_post():
+    """Пост «В этот день в финансах» — 08:30 ежедневно."""
+    draft = _take_draft("history") or render_history_post()
+    return _publish_draft(draft) if draft else None
 
-    for url in feeds:
+# ─── Новости (как было) ───────────────────────────────────────────────────────
+# Accept — как feedparser.http.ACCEPT_HEADER (сам feedparser здесь не нужен до первого разбора)
+RSS_HEADERS = {"User-Agent": "Mozilla/5.0",
+               "Accept": "application/atom+xml,application/rdf+xml,application/rss+xml,"
+                         "application/x-netcdf,application/xml;q=0.9,text/xml;q=0.2,*/*;q=0.1"}
+
+# ➕ Новое: кэш лент (условные GET), переживает перезапуски
+FEED_CACHE_LOCK = threading.Lock()
+FEED_CACHE_STATS = {"hits": 0, "misses": 0, "bytes_saved": 0, "bytes_downloaded": 0,
+                    "stream_stops": 0, "stream_fallbacks": 0}
+# url -> {etag, last_modified, entries, per_feed, size, checked_at}
+_FEED_CACHE = SharedJsonStore(FEED_CACHE_FILE, "feed_cache", "кэш лент")
+
+def _feed_cache() -> dict:
+    """Кэш с диска (перечитывается, если его обновил другой процесс). Вызывать под FEED_CACHE_LOCK."""
+    return _FEED_CACHE.data()
+
+def _prune_feed_cache(cache: dict):
+    cutoff = time.time() - FEED_CACHE_MAX_HOURS * 3600
+    # по возрасту последней проверки
+    for url in list(cache.keys()):
+        if cache[url].get("checked_at", 0) < cutoff:
+            del cache[url]
+    # по размеру — выкидываем давно не проверявшиеся
+    if len(cache) > FEED_CACHE_MAX_ITEMS:
+        keep = sorted(cache.items(), key=lambda kv: kv[1].get("checked_at", 0),
+                      reverse=True)[:FEED_CACHE_MAX_ITEMS]
+        cache.clear()
+        cache.update(keep)
+
+def _save_feed_cache():
+    with FEED_CACHE_LOCK:
+        _FEED_CACHE.save(prune=_prune_feed_cache)
+
+def _feed_cache_lookup(url: str, per_feed: int):
+    """Запись кэша, пригодная для условного GET (хватает записей и есть валидатор)."""
+    with FEED_CACHE_LOCK:
+        rec = _feed_cache().get(url)
+        if not rec or rec.get("per_feed", 0) < per_feed:
+            return None
+        if not (rec.get("etag") or rec.get("last_modified")):
+            return None
+        return rec
+
+def _feed_cache_store(url: str, headers, entries: list, per_feed: int, size: int):
+    with FEED_CACHE_LOCK:
+        FEED_CACHE_STATS["misses"] += 1
+        FEED_CACHE_STATS["bytes_downloaded"] += size
+        _feed_cache()[url] = {
+            "etag": headers.get("etag"),
+            "last_modified": headers.get("last-modified"),
+            "entries": entries,
+            "per_feed": per_feed,
+            "size": size,
+            "checked_at": time.time(),
+        }
+        _FEED_CACHE.touch(url)
+
+def _feed_cache_hit(url: str, rec: dict):
+    with FEED_CACHE_LOCK:
+        FEED_CACHE_STATS["hits"] += 1
+        FEED_CACHE_STATS["bytes_saved"] += rec.get("size", 0)
+        # rec мог устареть, если кэш тем временем перечитан с диска
+        current = _feed_cache().get(url)
+        if current is not None:
+            current["checked_at"] = time.time()
+            _FEED_CACHE.touch(url)
+
+# ➕ Новое: здоровье лент и предохранитель (closed → open → half_open → closed)
+FEED_HEALTH_LOCK = threading.Lock()
+# url -> {ok, fail, streak, state, open_until, opens, latency_s, entries, newest_at, …}
+_FEED_HEALTH = SharedJsonStore(FEED_HEALTH_FILE, "feed_health", "здоровье лент")
+
+def _feed_health() -> dict:
+    """Состояние с диска (перечитывается, если его обновил другой процесс). Вызывать под FEED_HEALTH_LOCK."""
+    return _FEED_HEALTH.data()
+
+def _prune_feed_health(health: dict):
+    # ленты, которых больше нет в rss_sources, не копим
+    known = {url for feeds in rss_sources.values() for url in feeds}
+    for url in [u for u in health if u not in known]:
+        del health[url]
+
+def _save_feed_health():
+    with FEED_HEALTH_LOCK:
+        _FEED_HEALTH.save(prune=_prune_feed_health)
+
+def _feed_allowed(url: str) -> bool:
+    """
+    Можно ли сейчас идти в ленту. Открытый предохранитель пропускает ленту до
+    open_until; после — ровно один пробный запрос (half_open), остальные ждут его итога.
+    """
+    now = time.time()
+    with FEED_HEALTH_LOCK:
+        rec = _feed_health().get(url)
+        if not rec or rec.get("state", "closed") == "closed":
+            return True
+        if rec["state"] == "open" and now >= rec.get("open_until", 0):
+            rec["state"], rec["probe_at"] = "half_open", now
+            _FEED_HEALTH.touch(url)
+            return True
+        if rec["state"] == "half_open" and now - rec.get("probe_at", 0) > 2 * RSS_FEED_TIMEOUT:
+            rec["probe_at"] = now  # проба потерялась (перезапуск, таймаут сбора) — пробуем снова
+            _FEED_HEALTH.touch(url)
+            return True
+        return False
+
+def _feed_health_record(url: str, latency: float, entries: list = None, error: str = None):
+    """Итог одной загрузки: entries — успех (в т.ч. 304), error — сбой или пустая лента."""
+    now = time.time()
+    with FEED_HEALTH_LOCK:
+        rec = _feed_health().setdefault(url, {"ok": 0, "fail": 0, "streak": 0, "opens": 0,
+                                              "state": "closed"})
+        _FEED_HEALTH.touch(url)
+        # сглаженная задержка: на медленные ленты видно тренд, а не последний выброс
+        rec["latency_s"] = round(latency if "latency_s" not in rec
+                                 else 0.7 * rec["latency_s"] + 0.3 * latency, 3)
+        rec["checked_at"] = now
+        if error is None:
+            rec["ok"] += 1
+            rec.update(streak=0, opens=0, state="closed", last_ok_at=now, entries=len(entries))
+            newest = max((e.get("published", "") for e in entries), default="")
+            if newest:
+                rec["newest_at"] = newest
+            rec.pop("open_until", None)
+            rec.pop("probe_at", None)
+            return
+        rec["fail"] += 1
+        rec["streak"] += 1
+        rec.update(last_error=error[:200], last_error_at=now)
+        if rec["state"] == "half_open" or rec["streak"] >= FEED_BREAKER_FAILURES:
+            rec["opens"] += 1
+            pause = min(FEED_BREAKER_MAX_MIN, FEED_BREAKER_BASE_MIN * 2 ** (rec["opens"] - 1))
+            rec.update(state="open", open_until=now + pause * 60)
+            logger.warning("🔌 Лента %s отключена на %.0f мин (%d ошибок подряд): %s",
+                           url, pause, rec["streak"], error)
+
+def _feed_health_view() -> dict:
+    now = time.time()
+    with FEED_HEALTH_LOCK:
+        health = _feed_health()
+        view = {}
+        for url, rec in health.items():
+            total = rec["ok"] + rec["fail"]
+            view[url] = dict(rec, success_rate=round(rec["ok"] / total, 3) if total else None,
+                             reopens_in_s=max(0, round(rec.get("open_until", now) - now)))
+        return view
+
+_FEED_ITEM_TAGS = {"item", "{http://purl.org/rss/1.0/}item", "{http://www.w3.org/2005/Atom}entry"}
+
+def _xml_local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+def _parse_feed_date(value: str):
+    """RFC 822 (RSS pubDate) или ISO 8601 (Atom, dc:date) → aware UTC datetime | None."""
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
         try:
-            feed = feedparser.parse(url, request_headers={"User-Agent": "Mozilla/5.0"})
-            for e in feed.entries[:per_feed]:
-                # published/updated fallback
-                if getattr(e, "published_parsed", None):
-                    published = datetime.fromtimestamp(mktime(e.published_parsed), tz=pytz.UTC)
-                elif getattr(e, "updated_parsed", None):
-                    published = datetime.fromtimestamp(mktime(e.updated_parsed), tz=pytz.UTC)
-                else:
-                    published = datetime.utcnow().replace(tzinfo=pytz.UTC)
-
-                # summary/description/content fallback
-                raw = e.get("summary") or e.get("description")
-                if not raw and e.get("content"):
-                    try:
-                        raw = e.content[0].value
-                    except Exception:
-                        raw = ""
-                summary = clean_html(raw).strip()
-
-                title = e.get("title", "").strip()
-                link = e.get("link", "")
-
-                if title:
-                    entries.append({
-                        "title": title,
-                        "summary": summary,
-                        "link": link,
-                        "published": published.isoformat()
-                    })
-        except Exception as ex:
-            logger.warning(f"RSS parse error {url}: {ex}")
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=pytz.UTC)
+    return dt.astimezone(pytz.UTC)
+
+def _stream_entry(elem) -> dict:
+    """Поля одной записи RSS/Atom — те же, что даёт _feed_entries из feedparser."""
+    fields = {}
+    for child in elem:
+        name = _xml_local(child.tag)
+        if name == "link":
+            # RSS: <link>url</link>; Atom: <link rel="alternate" href="url"/>
+            link = (child.text or "").strip() or (
+                child.get("href") if child.get("rel", "alternate") == "alternate" else "")
+            if link:
+                fields.setdefault("link", link)
+        elif name in ("title", "description", "summary", "encoded", "content",
+                      "pubDate", "published", "date", "issued", "updated", "modified"):
+            fields.setdefault(name, "".join(child.itertext()))
+    published = None
+    for name in ("pubDate", "published", "date", "issued", "updated", "modified"):
+        published = _parse_feed_date(fields.get(name))
+        if published:
+            break
+    raw = fields.get("summary") or fields.get("description") or fields.get("encoded") or fields.get("content")
+    return {
+        "title": (fields.get("title") or "").strip(),
+        "summary": clean_html(raw).strip(),
+        "link": fields.get("link", ""),
+        "published": (published or datetime.utcnow().replace(tzinfo=pytz.UTC)).isoformat(),
+    }
+
+class FeedStreamParser:
+    """
+    Инкрементальный разбор ленты: куски тела идут в XMLPullParser по мере загрузки,
+    из каждой записи берём только нужные поля и сразу освобождаем её узлы.
+    feed() возвращает True, когда набрано limit записей или съеден RSS_MAX_FEED_BYTES —
+    память и время растут с limit, а не с размером ленты.
+    Не разобралось (битый XML, HTML-сущности, кодировка, которую не знает expat) —
+    failed=True: тело докачивается до бюджета и уходит в feedparser.
+    parse=False — только считаем байты до бюджета (RSS_STREAM_PARSE=0).
+    """
 
-    if not entries:
-        return "Нет актуальных новостей по теме."
+    def __init__(self, limit: int, parse: bool = True):
+        self.limit = limit
+        self.parse = parse
+        self.entries = []
+        self.size = 0
+        self.failed = not parse
+        self._parser = ET.XMLPullParser(events=("end",))
+
+    def feed(self, chunk: bytes) -> bool:
+        self.size += len(chunk)
+        if not self.failed:
+            try:
+                self._parser.feed(chunk)
+                for _, elem in self._parser.read_events():
+                    if elem.tag in _FEED_ITEM_TAGS:
+                        entry = _stream_entry(elem)
+                        elem.clear()
+                        if entry["title"]:
+                            self.entries.append(entry)
+                            if len(self.entries) >= self.limit:
+                                return True
+            except ET.ParseError:
+                self.failed = True
+        return self.size >= RSS_MAX_FEED_BYTES
+
+def _download_feed(url: str, per_feed: int, cached: dict = None):
+    """
+    Качаем ленту с жёстким дедлайном RSS_FEED_TIMEOUT и разбираем записи.
+    RSS_STREAM_PARSE — потоково (FeedStreamParser), иначе/при сбое — feedparser из памяти.
+    Больше RSS_MAX_FEED_BYTES не качаем: огромная лента обрезается, а не считается сбоем.
+    Если есть запись кэша — шлём условный GET; на 304 возвращаем (None, headers, 0).
+    Иначе (entries, headers, прочитано байт).
+    """
+    headers = dict(RSS_HEADERS)
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    stream = FeedStreamParser(per_feed, parse=RSS_STREAM_PARSE)
+    # останавливает загрузку stream.feed на RSS_MAX_FEED_BYTES; max_bytes — лишь страховка
+    resp, body = http_get(url, headers=headers, timeout=RSS_FEED_TIMEOUT,
+                          max_bytes=max(HTTP_MAX_BYTES, 2 * RSS_MAX_FEED_BYTES),
+                          deadline=time.monotonic() + RSS_FEED_TIMEOUT,
+                          on_chunk=stream.feed)
+    if resp.status_code == 304 and cached:
+        return None, resp.headers, 0
+    resp.raise_for_status()
+    resp_headers = dict(resp.headers)
+    # для корректного разрешения относительных ссылок, как при parse(url)
+    resp_headers.setdefault("content-location", str(resp.url))
+    if not stream.failed:
+        if len(stream.entries) >= per_feed:
+            with FEED_CACHE_LOCK:
+                FEED_CACHE_STATS["stream_stops"] += 1
+        base = resp_headers["content-location"]
+        for entry in stream.entries:
+            if entry["link"]:
+                entry["link"] = urljoin(base, entry["link"])
+        return stream.entries, resp_headers, len(body)
+    if stream.parse:
+        with FEED_CACHE_LOCK:
+            FEED_CACHE_STATS["stream_fallbacks"] += 1
+    feed = feedparser.parse(body, response_headers=resp_headers)
+    return _feed_entries(feed, per_feed), resp_headers, len(body)
+
+def _feed_entries(feed, per_feed: int) -> list:
+    """Нормализуем первые per_feed записей ленты в dict'ы пайплайна."""
+    entries = []
+    for e in feed.entries[:per_feed]:
+        # published/updated fallback
+        if getattr(e, "published_parsed", None):
+            published = datetime.fromtimestamp(mktime(e.published_parsed), tz=pytz.UTC)
+        elif getattr(e, "updated_parsed", None):
+            published = datetime.fromtimestamp(mktime(e.updated_parsed), tz=pytz.UTC)
+        else:
+            published = datetime.utcnow().replace(tzinfo=pytz.UTC)
+
+        # summary/description/content fallback
+        raw = e.get("summary") or e.get("description")
+        if not raw and e.get("content"):
+            try:
+                raw = e.content[0].value
+            except Exception:
+                raw = ""
+        summary = clean_html(raw).strip()
+
+        title = e.get("title", "").strip()
+        link = e.get("link", "")
+
+        if title:
+            entries.append({
+                "title": title,
+                "summary": summary,
+                "link": link,
+                "published": published.isoformat()
+            })
+    return entries
+
+def _fetch_feed_entries(url: str, per_feed: int) -> list:
+    started = time.monotonic()
+    try:
+        with metric_timer("rss_fetch_seconds", feed=url):
+            cached = _feed_cache_lookup(url, per_feed)
+            entries, headers, size = _download_feed(url, per_feed, cached)
+            if entries is None:  # 304 Not Modified
+                _feed_cache_hit(url, cached)
+                entries = list(cached["entries"][:per_feed])
+            elif not entries:
+                # HTML-заглушка вместо ленты, редирект на главную и т.п.
+                raise ValueError("в ленте нет записей")
+            else:
+                _feed_cache_store(url, headers, entries, per_feed, size)
+        _feed_health_record(url, time.monotonic() - started, entries=entries)
+        return entries
+    except Exception as ex:
+        metric_inc("rss_fetch_failures_total", feed=url)
+        _feed_health_record(url, time.monotonic() - started, error=str(ex) or type(ex).__name__)
+        logger.warning(f"RSS parse error {url}: {ex}")
+        return None
 
-    cutoff = datetime.utcnow().replace(tzinfo=pytz.UTC) - timedelta(hours=lookback_hours)
-    fresh = [x for x in entries if datetime.fromisoformat(x["published"]) >= cutoff]
-    items = fresh or entries
+def _fetch_feeds_by_url(feeds: list, per_feed: int) -> dict:
+    """
+    Грузит ленты параллельно в RSS_POOL → {url: entries} только для успешных лент.
+    Ленты, не успевшие к RSS_TOTAL_TIMEOUT, пропускаются (их потоки доработают
+    в фоне и упрутся в свой дедлайн). Ленты с открытым предохранителем не запрашиваются.
+    """
+    skipped = [url for url in feeds if not _feed_allowed(url)]
+    for url in skipped:
+        metric_inc("rss_feed_skipped_total", feed=url)
+    if skipped:
+        logger.info("🔌 Пропускаем %d лент(ы) с открытым предохранителем", len(skipped))
+    feeds = [url for url in feeds if url not in skipped]
+    futures = [RSS_POOL.submit(_fetch_feed_entries, url, per_feed) for url in feeds]
+    total = _stage_remaining(RSS_TOTAL_TIMEOUT)
+    wait(futures, timeout=total)
+    result = {}
+    for url, fut in zip(feeds, futures):
+        if not fut.done():
+            fut.cancel()
+            logger.warning(f"RSS timeout {url}: не успели за {total:.0f}s")
+        elif fut.result() is not None:
+            result[url] = fut.result()
+    _save_feed_cache()
+    _save_feed_health()
+    return result
+
+# ➕ Новое: тёплое локальное хранилище новостей, наполняется фоновым джобом
+NEWS_STORE_LOCK = threading.Lock()
+# url -> {"topic", "entries", "fetched_at"}; наполняет лидер, читают все процессы
+_NEWS_STORE = SharedJsonStore(NEWS_STORE_FILE, "news_store", "хранилище новостей")
+
+def _news_store() -> dict:
+    """Хранилище с диска (перечитывается после каждого ingest лидера). Вызывать под NEWS_STORE_LOCK."""
+    return _NEWS_STORE.data()
+
+def _prune_news_store(store: dict):
+    cutoff = time.time() - NEWS_STORE_MAX_HOURS * 3600
+    for url in list(store.keys()):
+        if store[url].get("fetched_at", 0) < cutoff:
+            del store[url]
+
+def _save_news_store():
+    with NEWS_STORE_LOCK:
+        _NEWS_STORE.save(prune=_prune_news_store)
+
+def _news_store_put(topic: str, by_url: dict):
+    now = time.time()
+    with NEWS_STORE_LOCK:
+        store = _news_store()
+        # порядок записей внутри ленты сохраняем как есть (как при parse);
+        # свежесть по published отсекается уже при чтении
+        for url, entries in by_url.items():
+            store[url] = {"topic": topic, "entries": entries, "fetched_at": now}
+            _NEWS_STORE.touch(url)
+
+def _news_store_entries(topic: str, per_feed: int) -> list:
+    """Записи темы из хранилища в порядке rss_sources; упавшие ленты дают старые данные."""
+    cutoff = time.time() - NEWS_STORE_MAX_HOURS * 3600
+    with NEWS_STORE_LOCK:
+        store = _news_store()
+        entries = []
+        for url in rss_sources.get(topic, []):
+            rec = store.get(url)
+            if rec and rec.get("fetched_at", 0) >= cutoff:
+                entries.extend(rec["entries"][:per_feed])
+        return entries
+
+def ingest_feeds():
+    """Фоновый опрос всех лент rss_sources → локальное хранилище (без влияния на слоты)."""
+    started = time.monotonic()
+    total = ok = 0
+    for topic, feeds in rss_sources.items():
+        by_url = _fetch_feeds_by_url(feeds, NEWS_INGEST_PER_FEED)
+        _news_store_put(topic, by_url)
+        total += len(feeds); ok += len(by_url)
+    _save_news_store()
+    logger.info("📥 RSS ingest: %d/%d лент за %.1fs", ok, total, time.monotonic() - started)
+
+# ─── Кластеризация сюжетов (вместо LLM-ранжирования) ─────────────────────────
+# вес источника: федеральные агентства и крупные деловые издания чуть тяжелее
+SOURCE_WEIGHTS = {
+    "rbc.ru": 1.2, "tass.ru": 1.2, "interfax.ru": 1.2, "kommersant.ru": 1.2,
+    "vedomosti.ru": 1.2, "forbes.ru": 1.0, "moex.com": 1.1, "finam.ru": 1.0,
+    "reuters.com": 1.3, "ft.com": 1.3, "apnews.com": 1.2, "marketwatch.com": 1.1,
+    "coindesk.com": 1.2, "theblock.co": 1.1, "decrypt.co": 1.0, "forklog.com": 1.0,
+    "bitnovosti.com": 0.9, "bits.media": 0.9,
+}
 
-    # выбор «самой нашумевшей» через LLM
+_STOPWORDS = {
+    "это", "как", "что", "для", "при", "его", "она", "они", "все", "так", "уже", "или", "над",
+    "под", "без", "про", "после", "также", "будет", "может", "год", "году", "года",
+    "the", "and", "for", "with", "from", "that", "this", "are", "was", "has", "have", "will",
+    "its", "into", "over", "after", "amid", "says", "said",
+}
+_TOKEN_RE = re.compile(r"[^\W\d_]{3,}|\d+")
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_PERMS = [(random.Random(i).randrange(1, _MINHASH_PRIME), random.Random(~i).randrange(_MINHASH_PRIME))
+                  for i in range(NEWS_MINHASH_PERMS)]
+
+def _stems(text: str) -> set:
+    """Нормализованные «стемы» (ru/en): нижний регистр, ё→е, без стоп-слов,
+    обрезка до 5 символов как грубая морфология."""
+    text = text.lower().replace("ё", "е")
+    return {tok[:5] for tok in _TOKEN_RE.findall(text) if tok not in _STOPWORDS}
+
+def _story_shingles(item: dict) -> set:
+    """Стемы заголовка и начала summary — для MinHash."""
+    return _stems(f"{item.get('title', '')} {(item.get('summary') or '')[:300]}")
+
+def _same_title(a: set, b: set) -> bool:
+    """Заголовки об одном: общих стемов не меньше NEWS_CLUSTER_MIN_SHARED и не меньше
+    NEWS_CLUSTER_TITLE от более короткого (коэффициент перекрытия)."""
+    shared = len(a & b)
+    return (shared >= NEWS_CLUSTER_MIN_SHARED
+            and shared >= NEWS_CLUSTER_TITLE * min(len(a), len(b)))
+
+def _minhash(shingles: set) -> tuple:
+    hashes = [zlib.crc32(sh.encode("utf-8")) for sh in shingles] or [0]
+    return tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PERMS)
+
+def _source_of(item: dict) -> str:
+    host = urlsplit(item.get("link") or "").netloc.lower()
+    host = host[4:] if host.startswith("www.") else host
+    # feeds.reuters.com → reuters.com
+    return ".".join(host.split(".")[-2:]) if host else ""
+
+def _cluster_stories(items: list) -> list:
+    """
+    Склеивает почти-дубликаты (совпадающие заголовки — _same_title, или тексты
+    с оценкой Жаккара по MinHash ≥ NEWS_CLUSTER_JACCARD)
+    и возвращает кластеры по убыванию «шумности»:
+    [{"score", "sources", "items": [...]}]. Детерминированно для одного входа.
+    """
+    titles = [_stems(x.get("title", "")) for x in items]
+    sigs = [_minhash(_story_shingles(x)) for x in items]
+    parent = list(range(len(items)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in range(len(items)):
+        for j in range(i + 1, len(items)):
+            if find(i) == find(j):
+                continue
+            if _same_title(titles[i], titles[j]):
+                parent[find(j)] = find(i)
+                continue
+            same = sum(1 for a, b in zip(sigs[i], sigs[j]) if a == b)
+            if same >= NEWS_CLUSTER_JACCARD * NEWS_MINHASH_PERMS:
+                parent[find(j)] = find(i)
+
+    groups = {}
+    for i in range(len(items)):
+        groups.setdefault(find(i), []).append(i)
+
+    now = datetime.utcnow().replace(tzinfo=pytz.UTC)
+    clusters = []
+    for idxs in groups.values():
+        members = [items[i] for i in idxs]
+        sources = {_source_of(x) for x in members}
+        newest = max(datetime.fromisoformat(x["published"]) for x in members)
+        age_h = max(0.0, (now - newest).total_seconds() / 3600)
+        score = (sum(SOURCE_WEIGHTS.get(src, 1.0) for src in sources)
+                 + 2 ** (-age_h / NEWS_FRESH_HALFLIFE_H))
+        # представитель: самый весомый источник, затем самый свежий, затем порядок в списке
+        best = min(idxs, key=lambda i: (-SOURCE_WEIGHTS.get(_source_of(items[i]), 1.0),
+                                        -datetime.fromisoformat(items[i]["published"]).timestamp(), i))
+        clusters.append({"score": score, "sources": sorted(sources), "newest": newest,
+                         "first": min(idxs), "items": [items[best]] + [items[i] for i in idxs if i != best]})
+    clusters.sort(key=lambda c: (-c["score"], -c["newest"].timestamp(), c["first"]))
+    return clusters
+
+def _rank_with_llm(items: list) -> dict:
+    """Прежний выбор «самой нашумевшей» через gpt-4o; при сбое — самая свежая."""
     try:
         headlines = "\n".join([f"{i+1}. {x['title']}" for i, x in enumerate(items[:30])])
         prompt = (
@@ -710,17 +2895,59 @@ def fetch_buzzy_rss_news(topic, per_feed=5, lookback_hours=48):
             f"\n\nСписок заголовков:\n{headlines}"
         )
         # ✔ фикс: используем тот же метод, что и в остальных местах
-        resp = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2
-        )
+        _openai_throttle("text")
+        with metric_timer("openai_request_seconds", kind="rank"):
+            resp = _stage_client().chat.completions.create(
+                model="gpt-4o",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.2,
+                timeout=_stage_remaining(30.0),
+            )
         data = json.loads(resp.choices[0].message.content)
         idx = int(data.get("best_index", 1)) - 1
-        pick = items[max(0, min(idx, len(items)-1))]
+        return items[max(0, min(idx, len(items)-1))]
     except Exception as ex:
         logger.warning(f"LLM ranking failed, fallback to latest: {ex}")
-        pick = sorted(items, key=lambda x: x["published"], reverse=True)[0]
+        return sorted(items, key=lambda x: x["published"], reverse=True)[0]
+
+def _pick_buzzy(items: list) -> dict:
+    """
+    NEWS_RANKER: "local" — только кластеры; "hybrid" — LLM разбивает ничью
+    между лидерами (разница ≤ NEWS_TIE_EPS); "llm" — прежнее поведение.
+    """
+    if NEWS_RANKER == "llm":
+        return _rank_with_llm(items)
+    clusters = _cluster_stories(items)
+    top = clusters[0]
+    tied = [c for c in clusters if top["score"] - c["score"] <= NEWS_TIE_EPS]
+    logger.info("🧮 Кластеров: %d, лидер: %.2f (%s)", len(clusters), top["score"], ", ".join(top["sources"]))
+    if NEWS_RANKER == "hybrid" and len(tied) > 1:
+        return _rank_with_llm([c["items"][0] for c in tied])
+    return top["items"][0]
+
+def _pick_news_story(topic, per_feed=5, lookback_hours=48):
+    """Выбирает сюжет темы → (pick, story_id) или (None, None). seen не помечает."""
+    feeds = rss_sources.get(topic, [])
+    entries = _news_store_entries(topic, per_feed)
+    if not entries:
+        # холодный старт: хранилище ещё пустое — идём в сеть сами и прогреваем его
+        with trace_span("rss_fetch", feeds=len(feeds)) as span:
+            by_url = _fetch_feeds_by_url(feeds, per_feed)
+            span["ok_feeds"] = len(by_url)
+        _news_store_put(topic, by_url)
+        _save_news_store()
+        entries = [x for url in feeds for x in by_url.get(url, [])]
+
+    if not entries:
+        return None, None
+
+    cutoff = datetime.utcnow().replace(tzinfo=pytz.UTC) - timedelta(hours=lookback_hours)
+    fresh = [x for x in entries if datetime.fromisoformat(x["published"]) >= cutoff]
+    items = fresh or entries
+
+    # выбор «самой нашумевшей»: локальная кластеризация, LLM — по NEWS_RANKER
+    with trace_span("rank", ranker=NEWS_RANKER, items=len(items)):
+        pick = _pick_buzzy(items)
 
     # анти-повторы: если уже было, берем ближайшую свежую альтернативу
     sid = _story_id(pick["title"], pick.get("link", ""))
@@ -730,25 +2957,40 @@ def fetch_buzzy_rss_news(topic, per_feed=5, lookback_hours=48):
             if not _is_seen(alt_sid):
                 pick, sid = x, alt_sid
                 break
-    _mark_seen(sid)
+    return pick, sid
 
+def _news_facts(pick: dict) -> str:
     summary = pick["summary"] or ""
     if len(summary) > 300:
         summary = summary[:300] + "..."
     logger.info("📰 Источник: %s | %s", pick.get("title",""), pick.get("link",""))
     return f"{pick['title']}: {summary}"
 
-def scheduled_news_post():
-    # 🔁 теперь индексы устойчивы к перезапуску
-    idx = _next_index("news", len(news_themes))
-    topic = news_themes[idx]
-    today = datetime.now(pytz.timezone("Europe/Moscow")).strftime("%-d %B %Y")
+def fetch_buzzy_rss_news(topic, per_feed=5, lookback_hours=48):
+    pick, sid = _pick_news_story(topic, per_feed, lookback_hours)
+    if not pick:
+        return "Нет актуальных новостей по теме."
+    _mark_seen(sid)
+    return _news_facts(pick)
+
+def render_news_post(topic=None, day=None):
+    """
+    Готовит новостной пост без публикации. Сюжет помечается «уже было» только
+    при публикации (story_id в черновике), чтобы устаревший черновик не сжёг его.
+    """
+    if topic is None:
+        # 🔁 теперь индексы устойчивы к перезапуску
+        idx = _next_index("news", len(news_themes))
+        topic = news_themes[idx]
+    today = (day or datetime.now(pytz.timezone("Europe/Moscow"))).strftime("%-d %B %Y")
     logger.info(f"⏳ Генерация новостного поста: {topic}")
 
-    rss_news = fetch_buzzy_rss_news(topic)
-    if not rss_news or rss_news.startswith("Нет актуальных новостей"):
+    with job_stage("fetch"):
+        pick, sid = _pick_news_story(topic)
+    if not pick:
         logger.info("⏭️ Пропуск: нет свежих новостей по теме %s", topic)
-        return
+        return None
+    rss_news = _news_facts(pick)
     if len(rss_news) > 500:
         rss_news = rss_news[:500] + "..."
 
@@ -759,32 +3001,357 @@ def scheduled_news_post():
         f"{CONCRETE_HINT_NEWS}"
     )
 
-    text = generate_post_text(user_prompt)
-    if text:
-        title_line = _pick_title_line(text)
+    with job_stage("generate"):
+        text, caption_html, _ = generate_post(user_prompt)
+    if not text:
+        return None
+    title_line = _pick_title_line(text)
+    with job_stage("image"):
         image_url = generate_image(title_line, style="news")
-        if image_url:
-            publish_post(text, image_url)
+    if not image_url:
+        return None
+    return {"kind": "news", "topic": topic, "story_id": sid, "text": text,
+            "caption_html": caption_html, "image_url": image_url}
+
+def scheduled_news_post():
+    draft = _take_draft("news") or render_news_post(topic=_pop_planned_topic("news"))
+    return _publish_draft(draft) if draft else None
+
+# ─── Черновики: заранее готовим посты к слотам ────────────────────────────────
+DRAFT_LOCK = threading.Lock()
+MSK = pytz.timezone("Europe/Moscow")
+# тема, закреплённая за слотом при первой попытке пререндера: повторные попытки
+# и генерация в сам слот берут её же, а не сдвигают ротацию ещё раз
+_PLANNED_TOPICS = SharedJsonStore(PLANNED_TOPICS_FILE, "planned_topics", "темы слотов")  # draft key -> topic
+
+# неудачные попытки пререндера по слотам: draft key -> число. Живёт у лидера,
+# после перезапуска слот получает новые PRERENDER_MAX_FAILURES попыток
+_PRERENDER_FAILURES = {}
+
+def _key_slot(key: str) -> datetime:
+    return MSK.localize(datetime.strptime(key[:13], "%Y%m%d-%H%M"))
+
+def _set_planned_topic(key: str, topic):
+    """Вызывать под DRAFT_LOCK."""
+    def put(plans):
+        plans[key] = topic
+    _PLANNED_TOPICS.update(put)
+
+def _forget_planned_topic(key: str):
+    """Вызывать под DRAFT_LOCK."""
+    def drop(plans):
+        plans.pop(key, None)
+    _PLANNED_TOPICS.update(drop)
+
+def _publish_draft(draft: dict) -> bool:
+    with job_stage("publish"):
+        ok = publish_post(draft["text"], draft.get("image_url"), kind=draft["kind"],
+                          topic=draft.get("topic"), caption_html=draft.get("caption_html"),
+                          image_bytes=draft.get("image_bytes"))
+    if ok and draft.get("story_id"):
+        _mark_seen(draft["story_id"])
+    if ok and draft.get("event"):
+        _mark_event_used(draft["event"]["day"], draft["event"]["year"])
+    return ok
+
+def _upcoming_slots(now: datetime, limit: int) -> list:
+    """Ближайшие слоты SCHEDULE после now → [(slot_at, kind)] по времени."""
+    slots = []
+    for offset in (0, 1):
+        day = (now + timedelta(days=offset)).date()
+        for hour, minute, kind in SCHEDULE:
+            at = MSK.localize(datetime(day.year, day.month, day.day, hour, minute))
+            if at > now:
+                slots.append((at, kind))
+    return sorted(slots)[:limit]
+
+def _draft_key(slot_at: datetime, kind: str) -> str:
+    return f"{slot_at.strftime('%Y%m%d-%H%M')}-{kind}"
+
+def _draft_paths(key: str, root: str = DRAFTS_DIR):
+    return os.path.join(root, f"{key}.json"), os.path.join(root, f"{key}.png")
+
+def _save_draft(key: str, slot_at, draft: dict, root: str = DRAFTS_DIR):
+    """slot_at=None — черновик без слота (пакетная генерация)."""
+    meta_path, image_path = _draft_paths(key, root)
+    os.makedirs(root, exist_ok=True)
+    # сначала картинка, затем метаданные — черновик без картинки не появится
+    tmp = f"{image_path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(draft["image_bytes"])
+    os.replace(tmp, image_path)
+    meta = {k: v for k, v in draft.items() if k != "image_bytes"}
+    meta.update({"slot_at": slot_at.isoformat() if slot_at else None, "created_at": time.time()})
+    tmp = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp, meta_path)  # атомарная запись
+
+def _load_draft(key: str, root: str = DRAFTS_DIR):
+    meta_path, image_path = _draft_paths(key, root)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            draft = json.load(f)
+        with open(image_path, "rb") as f:
+            draft["image_bytes"] = f.read()
+        return draft
+    except Exception:
+        return None
+
+def _drop_draft(key: str):
+    for path in _draft_paths(key):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _draft_is_stale(draft: dict) -> bool:
+    """Новостной черновик старше NEWS_DRAFT_MAX_AGE_MIN — сюжет мог устареть."""
+    return (draft["kind"] == "news"
+            and time.time() - draft.get("created_at", 0) > NEWS_DRAFT_MAX_AGE_MIN * 60)
+
+def _list_drafts() -> list:
+    try:
+        return sorted(n[:-5] for n in os.listdir(DRAFTS_DIR) if n.endswith(".json"))
+    except FileNotFoundError:
+        return []
+
+def _take_draft(kind: str):
+    """Забирает черновик своего слота (±PRERENDER_GRACE_MIN); устаревший — выбрасывает."""
+    if not PRERENDER_ENABLED:
+        return None
+    now = datetime.now(MSK)
+    # черновик забирает ровно один процесс: load + drop под межпроцессной блокировкой
+    with DRAFT_LOCK, interprocess_lock("drafts"):
+        for key in _list_drafts():
+            if not key.endswith(f"-{kind}"):
+                continue
+            draft = _load_draft(key)
+            if not draft:
+                continue
+            if not _in_grace(datetime.fromisoformat(draft["slot_at"]), now):
+                continue
+            _drop_draft(key)
+            if _draft_is_stale(draft):
+                # тема остаётся за слотом: живая генерация возьмёт её через
+                # _pop_planned_topic, а не сдвинет ротацию ещё раз
+                if draft.get("topic") is not None:
+                    _set_planned_topic(key, draft["topic"])
+                logger.info("🗑️ Черновик %s устарел — генерируем заново (%s)", key, draft.get("topic"))
+                return None
+            _forget_planned_topic(key)
+            logger.info("📦 Публикуем готовый черновик %s", key)
+            return draft
+    return None
+
+def _in_grace(slot_at: datetime, now: datetime) -> bool:
+    return abs((slot_at - now).total_seconds()) <= PRERENDER_GRACE_MIN * 60
+
+def _pop_planned_topic(kind: str):
+    """Тема, заранее закреплённая за текущим слотом kind (если пререндер не успел)."""
+    now = datetime.now(MSK)
+    taken = []
+    def pop(plans):
+        for key in list(plans):
+            if key.endswith(f"-{kind}") and _in_grace(_key_slot(key), now):
+                taken.append(plans.pop(key))
+                return
+    with DRAFT_LOCK:
+        _PLANNED_TOPICS.update(pop)
+    return taken[0] if taken else None
+
+def _plan_topic(kind: str):
+    if kind == "news":
+        return news_themes[_next_index("news", len(news_themes))]
+    if kind == "rubric":
+        return rubrics[_next_index("rubric", len(rubrics), avoid_key="last_rubric", names=rubrics)]
+    return None
+
+def _render_for_slot(kind: str, slot_at: datetime, topic=None):
+    if kind == "news":
+        return render_news_post(topic=topic, day=slot_at)
+    if kind == "rubric":
+        return render_rubric_post(rubric=topic)
+    return render_history_post(day=slot_at)
+
+def prerender_posts():
+    """
+    Готовит черновики для ближайших PRERENDER_AHEAD слотов: текст, HTML-подпись
+    и скачанную картинку (ссылки DALL·E живут недолго). Новости — не раньше
+    чем за NEWS_DRAFT_LEAD_MIN до слота; устаревшие новостные черновики
+    пересобираются с той же темой, чтобы не сбивать ротацию.
+    """
+    now = datetime.now(MSK)
+    # подчищаем черновики прошедших слотов
+    with DRAFT_LOCK:
+        for key in _list_drafts():
+            draft = _load_draft(key)
+            if not draft or datetime.fromisoformat(draft["slot_at"]) < now - timedelta(minutes=PRERENDER_GRACE_MIN):
+                _drop_draft(key)
+        def prune(plans):
+            for key in list(plans):
+                if _key_slot(key) < now - timedelta(minutes=PRERENDER_GRACE_MIN):
+                    del plans[key]
+        _PLANNED_TOPICS.update(prune)
+        for key in [k for k in _PRERENDER_FAILURES
+                    if _key_slot(k) < now - timedelta(minutes=PRERENDER_GRACE_MIN)]:
+            del _PRERENDER_FAILURES[key]
+
+    for slot_at, kind in _upcoming_slots(now, PRERENDER_AHEAD):
+        lead = (slot_at - now).total_seconds() / 60
+        if lead > (NEWS_DRAFT_LEAD_MIN if kind == "news" else PRERENDER_LEAD_HOURS * 60):
+            continue
+        key = _draft_key(slot_at, kind)
+        with DRAFT_LOCK:
+            existing = _load_draft(key)
+            topic = existing.get("topic") if existing else _PLANNED_TOPICS.data().get(key)
+        if existing and not _draft_is_stale(existing):
+            continue
+        with DRAFT_LOCK:
+            failures = _PRERENDER_FAILURES.get(key, 0)
+        if failures >= PRERENDER_MAX_FAILURES:
+            continue  # каждая попытка — свежий текст LLM; слот соберётся вживую
+        draft = None
+        try:
+            if topic is None and kind != "history":
+                topic = _plan_topic(kind)
+                with DRAFT_LOCK:
+                    _set_planned_topic(key, topic)
+            draft = _render_for_slot(kind, slot_at, topic=topic)
+            if draft:
+                with job_stage("image"):
+                    draft["image_bytes"] = _download_image(draft["image_url"])
+                with DRAFT_LOCK:
+                    _save_draft(key, slot_at, draft)
+                logger.info("📝 Черновик %s готов (%s)", key, draft.get("topic"))
+        except Exception as e:
+            draft = None
+            logger.warning(f"Не удалось подготовить черновик {key}: {e}")
+        if not draft:
+            with DRAFT_LOCK:
+                _PRERENDER_FAILURES[key] = failures + 1
+            if failures + 1 >= PRERENDER_MAX_FAILURES:
+                logger.warning("⛔ Черновик %s не удался %d раз — слот соберётся вживую",
+                               key, failures + 1)
+
+def manual_post(kind: str):
+    """Ручной запуск (/test): собираем пост вживую, мимо черновиков и тем слотов."""
+    render = {"news": render_news_post, "rubric": render_rubric_post,
+              "history": render_history_post}[kind]
+    draft = render()
+    return _publish_draft(draft) if draft else None
+
+# ─── Пакетная генерация черновиков (CLI) ──────────────────────────────────────
+def _batch_plan(names: list, count: int) -> list:
+    """[(key, rubric)] — count постов по кругу по names. Ключ (номер рубрики +
+    порядковый номер) не зависит от count, поэтому дозапуск находит готовое."""
+    return [(f"rubric{rubrics.index(names[i % len(names)]):02d}-{i // len(names) + 1}",
+             names[i % len(names)]) for i in range(count)]
+
+def _batch_item(root: str, key: str, rubric: str) -> str:
+    meta_path, _ = _draft_paths(key, root)
+    if os.path.exists(meta_path):
+        return "skipped"  # готов с прошлого запуска (запись атомарная — недописанных нет)
+    draft = render_rubric_post(rubric=rubric)
+    if not draft:
+        return "failed"
+    draft["image_bytes"] = _download_image(draft["image_url"])
+    _save_draft(key, None, draft, root=root)
+    return "done"
+
+def _save_batch_manifest(root: str, manifest: dict):
+    path = os.path.join(root, "manifest.json")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)  # атомарная запись
+
+def run_batch(batch_id: str, names: list, count: int, workers: int) -> dict:
+    """
+    Готовит count рубричных черновиков (текст, HTML-подпись, картинка) в
+    BATCH_DIR/<batch_id>, ничего не публикуя. Параллельно — workers потоков,
+    запросы к OpenAI дополнительно ограничены OPENAI_BUCKETS. Повторный запуск
+    с тем же batch_id догенерирует только недостающее. → {статус: количество}.
+    """
+    root = os.path.join(BATCH_DIR, batch_id)
+    os.makedirs(root, exist_ok=True)
+    plan = _batch_plan(names, count)
+    manifest = {"batch_id": batch_id, "started_at": time.time(), "count": count,
+                "rubrics": names, "items": {key: {"rubric": rubric, "status": "pending"}
+                                            for key, rubric in plan}}
+    started = time.monotonic()
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch")
+    futures = {pool.submit(_batch_item, root, key, rubric): key for key, rubric in plan}
+    done = 0
+    try:
+        for fut in as_completed(futures):
+            key = futures[fut]
+            try:
+                status = fut.result()
+            except Exception as e:
+                status = "failed"
+                manifest["items"][key]["error"] = str(e)[:200]
+                logger.warning(f"Черновик {key} не получился: {e}")
+            manifest["items"][key]["status"] = status
+            done += 1
+            logger.info("📝 [%d/%d] %s (%s): %s", done, len(plan), key, manifest["items"][key]["rubric"], status)
+            _save_batch_manifest(root, manifest)
+    except KeyboardInterrupt:
+        # уже начатые генерации доработают и сохранятся; остальное — при дозапуске
+        pool.shutdown(wait=True, cancel_futures=True)
+        logger.warning("⏹️ Пакет %s прерван: готово %d/%d, повторите с --batch-id %s",
+                       batch_id, done, len(plan), batch_id)
+        raise
+    pool.shutdown()
+    summary = {}
+    for item in manifest["items"].values():
+        summary[item["status"]] = summary.get(item["status"], 0) + 1
+    manifest.update(finished_at=time.time(), elapsed_s=round(time.monotonic() - started, 1), summary=summary)
+    _save_batch_manifest(root, manifest)
+    logger.info("📦 Пакет %s: %s за %.0fs → %s", batch_id, summary, manifest["elapsed_s"], root)
+    return summary
+
+def batch_cli(argv: list) -> int:
+    """python main.py batch [--count N] [--rubrics a,b] [--workers N] [--rpm N] [--image-rpm N] [--batch-id ID]"""
+    rubric_slots = sum(1 for _, _, kind in SCHEDULE if kind == "rubric") * 7
+    parser = argparse.ArgumentParser(prog="python main.py batch",
+                                     description="Рубричные черновики пакетом, без публикации")
+    parser.add_argument("--count", type=int, default=rubric_slots,
+                        help=f"сколько постов (по умолчанию неделя слотов: {rubric_slots})")
+    parser.add_argument("--rubrics", default="", help="через запятую; по умолчанию все рубрики")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--rpm", type=float, default=OPENAI_RPM or 60, help="запросов к чату в минуту")
+    parser.add_argument("--image-rpm", type=float, default=OPENAI_IMAGE_RPM or 7,
+                        help="картинок DALL·E в минуту")
+    parser.add_argument("--batch-id", default=datetime.now(MSK).strftime("rubrics-%G-W%V"),
+                        help="каталог в BATCH_DIR; тот же id — продолжить прерванный пакет")
+    args = parser.parse_args(argv)
+    names = [n.strip() for n in args.rubrics.split(",") if n.strip()] or list(rubrics)
+    unknown = [n for n in names if n not in rubrics]
+    if unknown:
+        parser.error(f"нет таких рубрик: {', '.join(unknown)}")
+    set_openai_rpm("text", args.rpm)
+    set_openai_rpm("image", args.image_rpm)
+    try:
+        summary = run_batch(args.batch_id, names, args.count, args.workers)
+    except KeyboardInterrupt:
+        return 130
+    return 0 if not summary.get("failed") else 1
 
 # ─── Ручные тесты (как были) ──────────────────────────────────────────────────
 def test_rubric_post(rubric_name):
     logger.info(f"⏳ Ручная генерация рубричного поста: {rubric_name}")
-    attempts, text = 0, None
-    while attempts < 5:
-        text = generate_post_text(
-            f"Создай структурированный и интересный Telegram-пост по рубрике: {rubric_name}. {CONCRETE_HINT_RUBRIC}",
-            system_prompt=SYSTEM_PROMPT
-        )
-        if text and len(text) <= 1015:
-            break
-        attempts += 1
-    else:
+    text, caption_html, _ = generate_post(
+        f"Создай структурированный и интересный Telegram-пост по рубрике: {rubric_name}. {CONCRETE_HINT_RUBRIC}",
+        system_prompt=SYSTEM_PROMPT
+    )
+    if not text:
         logger.warning("⚠️ GPT не смог уложиться в лимит. Возвращаем None.")
         return
     title_line = _pick_title_line(text)
     image_url = generate_image(title_line, style="news")
     if image_url:
-        publish_post(text, image_url)
+        publish_post(text, image_url, kind="rubric", topic=rubric_name, caption_html=caption_html)
 
 def test_news_post(rubric_name):
     logger.info(f"⏳ Ручная генерация новостного поста: {rubric_name}")
@@ -798,33 +3365,296 @@ def test_news_post(rubric_name):
         f"Сделай пост живым, структурным, не более 990 символов. Вставь подзаголовок-зацеп. В конце — вопрос подписчику. "
         f"{CONCRETE_HINT_NEWS}"
     )
-    text = generate_post_text(user_prompt)
+    text, caption_html, _ = generate_post(user_prompt)
     if text:
         title_line = _pick_title_line(text)
         image_url = generate_image(title_line, style="news")
         if image_url:
-            publish_post(text, image_url)
+            publish_post(text, image_url, kind="news", topic=rubric_name, caption_html=caption_html)
 
-# ─── Расписание (МСК) ─────────────────────────────────────────────────────────
-# новый пост истории — САМЫЙ ПЕРВЫЙ
-scheduler.add_job(scheduled_history_post, 'cron', hour=8,  minute=30)
+# ─── Фоновые задачи: пул, лимиты по типам, стадии ─────────────────────────────
+JOBS_LOCK = threading.Lock()
+JOBS = OrderedDict()  # job id -> запись задачи (последние JOB_HISTORY завершённых)
+_JOB_RUNNING = {}     # тип -> сколько задач выполняется
+_JOB_PENDING = {}     # тип -> [job id] в очереди
+_JOB_CTX = threading.local()  # текущая задача потока (для стадий)
+
+class JobStageTimeout(Exception):
+    """Стадия задачи вышла за свой дедлайн — следующие стадии не запускаются."""
+
+def _job_limit(kind: str) -> int:
+    return JOB_TYPE_LIMITS.get(kind, JOB_TYPE_LIMIT)
+
+def _trim_jobs():
+    finished = [jid for jid, job in JOBS.items() if job["finished_at"]]
+    for jid in finished[:max(0, len(finished) - JOB_HISTORY)]:
+        del JOBS[jid]
+
+def submit_job(kind: str, fn, key: str = None):
+    """
+    Ставит задачу в очередь пула → (job, coalesced). Повторный запуск, пока
+    такая же задача (тот же kind/key) ещё ждёт в очереди, не создаёт новую:
+    триггеры склеиваются. Выполняющаяся задача не мешает поставить ещё одну.
+    """
+    key = key or kind
+    with JOBS_LOCK:
+        for jid in _JOB_PENDING.get(kind, []):
+            if JOBS[jid]["key"] == key:
+                JOBS[jid]["triggers"] += 1
+                logger.info("🔁 Задача %s (%s) уже в очереди — запуск склеен", jid, kind)
+                return JOBS[jid], True
+        job = {"id": uuid.uuid4().hex[:12], "type": kind, "key": key, "status": "queued",
+               "created_at": time.time(), "started_at": None, "finished_at": None,
+               "stages": [], "spans": [], "result": None, "error": None, "triggers": 1,
+               "_fn": fn, "_deadline": None, "_t0": None}
+        JOBS[job["id"]] = job
+        _JOB_PENDING.setdefault(kind, []).append(job["id"])
+        _trim_jobs()
+    _dispatch_jobs(kind)
+    return job, False
+
+def _dispatch_jobs(kind: str):
+    with JOBS_LOCK:
+        while _JOB_PENDING.get(kind) and _JOB_RUNNING.get(kind, 0) < _job_limit(kind):
+            job = JOBS[_JOB_PENDING[kind].pop(0)]
+            _JOB_RUNNING[kind] = _JOB_RUNNING.get(kind, 0) + 1
+            JOB_POOL.submit(_run_job, job)
+
+def _run_job(job: dict):
+    _JOB_CTX.job = job
+    with JOBS_LOCK:
+        job["status"], job["started_at"], job["_t0"] = "running", time.time(), time.monotonic()
+    logger.info("▶️ Задача %s (%s) запущена", job["id"], job["type"])
+    status, result, error = "done", None, None
+    try:
+        result = job["_fn"]()
+    except JobStageTimeout as e:
+        status, error = "timeout", str(e)
+        logger.warning("⏱️ Задача %s (%s): %s", job["id"], job["type"], e)
+    except Exception as e:
+        status, error = "failed", str(e)
+        logger.error(f"Задача {job['id']} ({job['type']}) упала: {e}")
+    finally:
+        _JOB_CTX.job = None
+        metric_inc("jobs_total", type=job["type"], status=status)
+        with JOBS_LOCK:
+            job.update(status=status, result=result, error=error, finished_at=time.time(),
+                       _deadline=None)
+            _JOB_RUNNING[job["type"]] -= 1
+        _write_run_trace(job)
+        _dispatch_jobs(job["type"])
+
+@contextmanager
+def job_stage(name: str):
+    """
+    Стадия текущей задачи (fetch/generate/image/publish): время и статус видны
+    в /jobs/<id>. Остаток дедлайна стадии (_stage_remaining, не меньше 5 с) уходит
+    в таймауты сетевых вызовов внутри: OpenAI, Telegram, ленты, картинки, onthisday;
+    тела http_get и стрим LLM режутся по общему сроку, а не только по таймауту чтения.
+    Так зависший вызов прерывается; вышедшая за дедлайн стадия (overrun) не даёт
+    начаться следующей. Вне задачи — ничего не делает.
+    """
+    job = getattr(_JOB_CTX, "job", None)
+    if job is None:
+        yield
+        return
+    if job["stages"] and job["stages"][-1]["status"] == "overrun":
+        raise JobStageTimeout(f"стадия {job['stages'][-1]['name']} вышла за дедлайн")
+    limit = JOB_STAGE_DEADLINES.get(name)
+    started = time.monotonic()
+    stage = {"name": name, "status": "running", "deadline_s": limit,
+             "started_at": time.time(), "start_s": round(started - job["_t0"], 3),
+             "elapsed_s": None}
+    with JOBS_LOCK:
+        job["stages"].append(stage)
+        job["_deadline"] = started + limit if limit else None
+    status = "failed"
+    try:
+        yield
+        status = "overrun" if limit and time.monotonic() - started > limit else "ok"
+    finally:
+        elapsed = time.monotonic() - started
+        metric_observe("job_stage_seconds", elapsed, stage=name)
+        with JOBS_LOCK:
+            stage.update(status=status, elapsed_s=round(elapsed, 2))
+            job["_deadline"] = None
+
+def _stage_client():
+    """
+    OpenAI-клиент для вызова внутри стадии задачи — без встроенных повторов SDK:
+    каждый такой повтор заново ждёт весь таймаут (остаток дедлайна) и выводит
+    стадию за срок. Повторы внутри стадии делает сам пайплайн (PostBudget).
+    """
+    return client.with_options(max_retries=0) if getattr(_JOB_CTX, "job", None) else client
+
+def _stage_remaining(default: float) -> float:
+    """Таймаут для вызова внутри стадии: остаток её дедлайна (не больше default, не меньше 5 с)."""
+    job = getattr(_JOB_CTX, "job", None)
+    deadline = job and job["_deadline"]
+    if not deadline:
+        return default
+    return max(5.0, min(default, deadline - time.monotonic()))
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    """
+    Спан внутри текущей задачи: начало (от старта задачи), длительность, стадия,
+    атрибуты (attempt, via, …) и итог. Итог можно задать через span["outcome"],
+    иначе "ok" (или текст исключения). Вне задачи — ничего не пишет.
+    """
+    job = getattr(_JOB_CTX, "job", None)
+    span = dict(attrs)
+    if job is None:
+        yield span
+        return
+    started = time.monotonic()
+    span = {"name": name, "stage": job["stages"][-1]["name"] if job["stages"] else None,
+            "start_s": round(started - job["_t0"], 3), **attrs}
+    try:
+        yield span
+    except Exception as e:
+        span.setdefault("outcome", f"error: {e}"[:200])
+        raise
+    finally:
+        span["duration_s"] = round(time.monotonic() - started, 3)
+        span.setdefault("outcome", "ok")
+        with JOBS_LOCK:
+            job["spans"].append(span)
+
+TRACE_LOCK = threading.Lock()
+
+def _write_run_trace(job: dict):
+    """Дописывает прогон в TRACE_FILE; файл больше TRACE_MAX_BYTES уезжает в .1."""
+    if not TRACE_ENABLED:
+        return
+    with JOBS_LOCK:
+        record = {k: v for k, v in job.items() if not k.startswith("_")}
+        record["stages"] = [dict(s) for s in job["stages"]]
+        record["spans"] = [dict(s) for s in job["spans"]]
+    record["duration_s"] = round(record["finished_at"] - record["started_at"], 3)
+    line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+    try:
+        with TRACE_LOCK:
+            if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) + len(line) > TRACE_MAX_BYTES:
+                os.replace(TRACE_FILE, TRACE_FILE + ".1")
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line)
+    except Exception as e:
+        logger.warning(f"Не удалось записать трассу прогона: {e}")
 
-scheduler.add_job(scheduled_news_post,   'cron', hour=9,  minute=26)
-scheduler.add_job(scheduled_rubric_post, 'cron', hour=11, minute=42)
-scheduler.add_job(scheduled_news_post,   'cron', hour=13, minute=24)
-scheduler.add_job(scheduled_rubric_post, 'cron', hour=16, minute=5)
-scheduler.add_job(scheduled_news_post,   'cron', hour=18, minute=47)
-scheduler.add_job(scheduled_rubric_post, 'cron', hour=19, minute=47)
+def _read_runs(limit: int) -> list:
+    """Последние limit прогонов из TRACE_FILE (и .1, если мало), новые — первыми."""
+    runs = []
+    for path in (TRACE_FILE, TRACE_FILE + ".1"):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            continue
+        for line in reversed(lines):
+            try:
+                runs.append(json.loads(line))
+            except ValueError:
+                continue  # недописанная строка
+            if len(runs) >= limit:
+                return runs
+    return runs
+
+def _run_breakdown(run: dict) -> dict:
+    """Куда ушло время прогона: секунды по стадиям и самые долгие спаны."""
+    by_stage = {}
+    for st in run.get("stages", []):
+        by_stage[st["name"]] = round(by_stage.get(st["name"], 0) + (st.get("elapsed_s") or 0), 3)
+    slowest = sorted(run.get("spans", []), key=lambda s: s.get("duration_s", 0), reverse=True)[:3]
+    return {"id": run.get("id"), "type": run.get("type"), "status": run.get("status"),
+            "result": run.get("result"), "started_at": run.get("started_at"),
+            "duration_s": run.get("duration_s"), "stages": by_stage,
+            "llm_attempts": sum(1 for s in run.get("spans", []) if s["name"] == "llm"),
+            "slowest": [{k: s.get(k) for k in ("name", "stage", "attempt", "duration_s", "outcome")}
+                        for s in slowest]}
+
+def _job_view(job_id: str):
+    with JOBS_LOCK:
+        job = JOBS.get(job_id)
+        if job is None:
+            return None
+        view = {k: v for k, v in job.items() if not k.startswith("_")}
+        view["stages"] = [dict(s) for s in job["stages"]]
+        view["spans"] = [dict(s) for s in job["spans"]]
+    end = view["finished_at"] or time.time()
+    view["elapsed_s"] = round(end - view["started_at"], 2) if view["started_at"] else None
+    if view["status"] == "queued":
+        with JOBS_LOCK:
+            pending = _JOB_PENDING.get(view["type"], [])
+            view["queue_position"] = pending.index(job_id) + 1 if job_id in pending else None
+    return view
+
+# ─── Расписание (МСК) ─────────────────────────────────────────────────────────
+SCHEDULED_JOBS = {
+    "history": scheduled_history_post,
+    "news": scheduled_news_post,
+    "rubric": scheduled_rubric_post,
+}
+def setup_schedule():
+    """Регистрирует задачи в APScheduler (импорт APScheduler — здесь, не при старте)."""
+    # APScheduler только ставит задачу в JOB_POOL: лимиты по типам и склейка там же
+    for hour, minute, kind in SCHEDULE:
+        scheduler.add_job(submit_job, 'cron', hour=hour, minute=minute,
+                          args=[kind, SCHEDULED_JOBS[kind]], coalesce=True, max_instances=1)
+
+    # события «В этот день» — заранее на несколько дней вперёд (и сразу при старте)
+    scheduler.add_job(prefetch_onthisday, 'cron', hour=3, minute=15,
+                      next_run_time=datetime.now(pytz.timezone("Europe/Moscow")),
+                      coalesce=True, max_instances=1)
+
+    # черновики к ближайшим слотам — чтобы в слот оставалось только отправить
+    if PRERENDER_ENABLED:
+        scheduler.add_job(submit_job, 'interval', minutes=PRERENDER_MINUTES,
+                          args=["prerender", prerender_posts], coalesce=True, max_instances=1)
+
+    # фоновый прогрев хранилища новостей — сразу при старте и дальше по интервалу
+    scheduler.add_job(ingest_feeds, 'interval', minutes=NEWS_INGEST_MINUTES,
+                      next_run_time=datetime.now(pytz.timezone("Europe/Moscow")),
+                      coalesce=True, max_instances=1)
+
+def warm_up():
+    """Импорт зависимостей и сборка клиентов заранее, чтобы первый слот за это не платил."""
+    for lazy in (httpx, http, feedparser, telegram, bot, client):
+        lazy.load()
+
+def start_background():
+    """
+    Фоновая часть процесса: прогрев клиентов, затем выборы лидера. APScheduler
+    запускается только у лидера, так что слоты не дублируются при нескольких
+    репликах или воркерах (под gunicorn — из хука post_worker_init в gunicorn.conf.py).
+    Остальные процессы обслуживают HTTP и подхватывают лидерство, если лидер умер.
+    """
+    started = time.perf_counter()
+    warm_up()
+    STARTUP_TIMINGS["warm up"] = round(time.perf_counter() - started, 3)
+    if not try_become_leader():
+        logger.info("👥 Планировщик уже работает в другом процессе (%s) — этот ждёт лидерства",
+                    _leader_info())
+        while not try_become_leader():
+            time.sleep(LEADER_RETRY_SECONDS)
+    setup_schedule()
+    scheduler.start()
+    logger.info("🗓️ APScheduler запущен (лидер pid=%d; прогрев %.2fs, с запуска процесса %.2fs): %s",
+                os.getpid(), STARTUP_TIMINGS["warm up"], time.perf_counter() - _BOOT_STARTED,
+                STARTUP_TIMINGS)
+
+STARTUP_TIMINGS["import main"] = round(time.perf_counter() - _BOOT_STARTED, 3)
+logger.info("⏱️ main.py загружен за %.3fs", STARTUP_TIMINGS["import main"])
 
 # ─── Запуск под Railway ───────────────────────────────────────────────────────
 if __name__ == "__main__":
     import threading
 
-    def run_scheduler():
-        scheduler.start()
-        logger.info("🗓️ APScheduler запущен")
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        sys.exit(batch_cli(sys.argv[2:]))
 
-    threading.Thread(target=run_scheduler, daemon=True).start()
+    # Flask уже отвечает на /ping — тяжёлое и выборы лидера идут в фоне
+    threading.Thread(target=start_background, daemon=True).start()
 
     port = int(os.getenv("PORT", "8080"))
     logger.info(f"🌐 Flask слушает порт {port}")